@@ -0,0 +1,125 @@
+'''
+benchmark-tag-reading - Compares the old "loop over every frame" tag reading with media_tags.read_tags()
+
+Builds a sample MP3 in a temporary folder with the kind of tag that makes the old loop slow
+(large cover art, lyrics, dozens of TXXX frames from Picard), then reads it repeatedly both
+ways and checks they agree. Pass your own files to measure them instead.
+
+NOTE: Pylance complains about subclasses not being exported by mutagen. It's safe to ignore.
+'''
+
+import os
+import argparse
+import tempfile
+from timeit import default_timer as timer
+import mutagen
+import mutagen.id3
+from mutagen.mp3 import MP3
+from media_tags import TrackTags, TXXX_FIELDS, read_tags, first_text, year_from_text
+
+# One silent MPEG-1 Layer III frame, 128 kbps at 44.1 kHz
+MPEG_FRAME = b'\xff\xfb\x90\x00' + b'\x00' * 413
+
+def make_sample(filename:str, cover_bytes:int, txxx_count:int):
+    with open(filename, "wb") as f:
+        f.write(MPEG_FRAME * 2000)
+    tags = mutagen.id3.ID3() # type: ignore
+    tags.add(mutagen.id3.TALB(encoding=3, text=["Album"])) # type: ignore
+    tags.add(mutagen.id3.TPE1(encoding=3, text=["Artist"])) # type: ignore
+    tags.add(mutagen.id3.TPE2(encoding=3, text=["Album Artist"])) # type: ignore
+    tags.add(mutagen.id3.TIT2(encoding=3, text=["Title"])) # type: ignore
+    tags.add(mutagen.id3.TCON(encoding=3, text=["Rock"])) # type: ignore
+    tags.add(mutagen.id3.TDRC(encoding=3, text=["1978-05-01"])) # type: ignore
+    tags.add(mutagen.id3.TRCK(encoding=3, text=["3/12"])) # type: ignore
+    tags.add(mutagen.id3.TPOS(encoding=3, text=["1/2"])) # type: ignore
+    tags.add(mutagen.id3.GRP1(encoding=3, text=["classic-rock|am-gold"])) # type: ignore
+    tags.add(mutagen.id3.POPM(email="MusicBee", rating=204, count=0)) # type: ignore
+    tags.add(mutagen.id3.TXXX(encoding=3, desc="originalyear", text=["1977"])) # type: ignore
+    for desc in TXXX_FIELDS:
+        tags.add(mutagen.id3.TXXX(encoding=3, desc=desc, text=["%s value" % (desc)])) # type: ignore
+    for i in range(txxx_count):
+        tags.add(mutagen.id3.TXXX(encoding=3, desc="Extra %d" % (i), text=["value %d" % (i)])) # type: ignore
+    tags.add(mutagen.id3.USLT(encoding=3, lang="eng", desc="", text="la la la\n" * 500)) # type: ignore
+    tags.add(mutagen.id3.APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=os.urandom(cover_bytes))) # type: ignore
+    tags.save(filename)
+
+def read_tags_loop(mediafile:str) -> TrackTags:
+    # The way the scripts used to do it: decode every frame, then walk them all
+    mp3file = MP3(mediafile)
+    ret = TrackTags(path=mediafile)
+    ret.length = int(((mp3file.info.length * 1000) + 1000)/1000)
+    ret.filesize = os.path.getsize(mediafile)
+    tags = getattr(mp3file, "tags")
+    original_year = 0
+    for tag in filter(lambda t: t.startswith(("")), tags):
+        frame = tags[tag]
+        if isinstance(frame, mutagen.id3.TALB): # type: ignore
+            ret.album = first_text(frame)
+        elif isinstance(frame, mutagen.id3.TPE1): # type: ignore
+            ret.artist = first_text(frame)
+        elif isinstance(frame, mutagen.id3.TPE2): # type: ignore
+            ret.albumartist = first_text(frame)
+        elif isinstance(frame, mutagen.id3.TIT2): # type: ignore
+            ret.title = first_text(frame)
+        elif isinstance(frame, mutagen.id3.POPM): # type: ignore
+            ret.rating = int(getattr(frame, "rating"))
+            ret.has_rating = True
+        elif isinstance(frame, mutagen.id3.GRP1): # type: ignore
+            ret.grouping = [str(x) for x in getattr(frame, "text")]
+        elif isinstance(frame, mutagen.id3.TCON): # type: ignore
+            ret.genres = [x.strip() for x in frame.genres if len(x.strip()) > 0]
+        elif isinstance(frame, mutagen.id3.TRCK): # type: ignore
+            ret.track = first_text(frame)
+        elif isinstance(frame, mutagen.id3.TPOS): # type: ignore
+            ret.disc = first_text(frame)
+        elif isinstance(frame, mutagen.id3.TXXX): # type: ignore
+            key = getattr(frame, "desc")
+            if key == "originalyear":
+                original_year = year_from_text(first_text(frame))
+            elif key in TXXX_FIELDS:
+                setattr(ret, TXXX_FIELDS[key], first_text(frame))
+        elif isinstance(frame, mutagen.id3.TDRC): # type: ignore
+            ret.date = first_text(frame)
+    ret.year = original_year if original_year > 0 else year_from_text(ret.date)
+    return ret
+
+def measure(func, mediafiles:list, repeat:int) -> float:
+    start = timer()
+    for i in range(repeat):
+        for mediafile in mediafiles:
+            func(mediafile)
+    return timer() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark tag reading')
+    parser.add_argument('input', nargs="*", help='MP3 files to read (default: a generated sample)')
+    parser.add_argument("-n", "--repeat", help="Times to read each file (default: 200)", default=200, type=int)
+    parser.add_argument("--cover", help="Cover art size in bytes for the sample (default: 500000)", default=500000, type=int)
+    parser.add_argument("--txxx", help="Extra TXXX frames in the sample (default: 40)", default=40, type=int)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        mediafiles = args.input
+        if len(mediafiles) == 0:
+            sample = os.path.join(folder, "sample.mp3")
+            make_sample(sample, args.cover, args.txxx)
+            mediafiles = [sample]
+
+        for mediafile in mediafiles:
+            if read_tags_loop(mediafile) != read_tags(mediafile):
+                print("Results differ for %s" % (mediafile))
+                return
+
+        # Warm up the OS file cache so both sides measure parsing, not the disk
+        measure(read_tags, mediafiles, 1)
+
+        total = len(mediafiles) * args.repeat
+        loop = measure(read_tags_loop, mediafiles, args.repeat)
+        targeted = measure(read_tags, mediafiles, args.repeat)
+        print("Loop over all frames: %8.3f s (%8.1f files/sec)" % (loop, total / loop))
+        print("Targeted lookup:      %8.3f s (%8.1f files/sec)" % (targeted, total / targeted))
+        print("Speedup:              %8.2fx" % (loop / targeted))
+
+if __name__ == '__main__':
+    main()
@@ -23,17 +23,10 @@ from unidecode import unidecode
 import mutagen
 import mutagen.id3
 import re
+from media_scanner import find_media
+from media_tags import load_id3
+from tag_writer import TagWriter
 
-def get_ext(filename, tolower=False) -> str:
-    ext = ""
-    idx = filename.rfind('.')
-    if idx >= 0:
-        ext = filename[idx + 1:]
-    if tolower:
-        return ext.lower()
-    else:
-        return ext
-    
 def term_exists(tag:str, terms:list, case=False) -> bool:
     if not case:
         tag = tag.lower()
@@ -43,6 +36,25 @@ def term_exists(tag:str, terms:list, case=False) -> bool:
             return True
     return False
 
+def find_terms(id3file, terms:list, case=False):
+    to_delete = list()
+    to_modify = list()
+    for tag in filter(lambda t: t.startswith(("")), id3file):
+        frame = id3file[tag]
+        if isinstance(frame, mutagen.id3.TextFrame): # type: ignore
+            if term_exists(str(getattr(frame,"text")), terms, case):
+                if isinstance(frame, mutagen.id3.TPE1) or isinstance(frame, mutagen.id3.TPE2): # type: ignore
+                    to_modify.append(tag)
+                else:
+                    to_delete.append(tag)
+        elif isinstance(frame, mutagen.id3.UrlFrame): # type: ignore
+            if term_exists(str(getattr(frame,"url")), terms, case):
+                to_delete.append(tag)
+        elif isinstance(frame, mutagen.id3.USLT): # type: ignore
+            if term_exists(str(getattr(frame,"text")), terms, case):
+                to_delete.append(tag)
+    return to_delete, to_modify
+
 def main():
     parser = argparse.ArgumentParser(description='List metadata tags from media files')
     parser.add_argument('input', help='Media file or a folder of media files')
@@ -81,69 +93,51 @@ def main():
 
     media_extensions = ["mp3","m4a","m4b"]
 
-    mediafiles = list()
-    if os.path.isdir(args.input):
-        for root, dirs, files in os.walk(args.input):
-            for file in files:
-                filename = str(file)
-                if get_ext(filename, tolower=True) in media_extensions:
-                    mediafiles.append(os.path.join(root, file))
-    else:
-        filename = str(args.input)
-        if get_ext(filename, tolower=True) in media_extensions:
-            mediafiles.append(args.input)
-        else:
-            print("%s is not a supported media file type" % args.input)
-    mediafiles.sort()
-    
-    if len(mediafiles) == 0:
-        print("No files to process")
-        return
+    mediafiles = find_media(args.input, media_extensions)
+    writer = TagWriter()
 
     # This is the part where the magic happens. Walk the list of tag types in the input
-    # file and mark the ones that need to be deleted.
+    # file and mark the ones that need to be deleted. Most files don't contain any of the
+    # terms, so the check runs on a bounded read of the tag block and the file is only
+    # opened for writing when something has to change.
     for mediafile in mediafiles:
         head,tail = os.path.split(Path(mediafile))
         output_str = tail + ":"
 
-        id3file = mutagen.id3.ID3(mediafile)
-        if id3file is not None:
-            to_delete = list()
-            to_modify = list()
-            for tag in filter(lambda t: t.startswith(("")), id3file):
+        try:
+            id3file = load_id3(mediafile, known_frames=None)
+        except Exception as e:
+            print("%s: %s" % (mediafile, e))
+            continue
+        if id3file is None:
+            continue
+
+        to_delete, to_modify = find_terms(id3file, terms, args.case)
+        if (len(to_delete) > 0) or (len(to_modify) > 0):
+            if not args.dryrun:
+                id3file = mutagen.id3.ID3(mediafile) # type: ignore
+            for tag in to_modify:
                 frame = id3file[tag]
-                if isinstance(frame, mutagen.id3.TextFrame): # type: ignore
-                    if term_exists(str(getattr(frame,"text")), terms, args.case):
-                        if isinstance(frame, mutagen.id3.TPE1) or isinstance(frame, mutagen.id3.TPE2): # type: ignore
-                            to_modify.append(tag)
-                        else:
-                            to_delete.append(tag)
-                elif isinstance(frame, mutagen.id3.UrlFrame): # type: ignore
-                    if term_exists(str(getattr(frame,"url")), terms, args.case):
-                        to_delete.append(tag)
-                elif isinstance(frame, mutagen.id3.USLT): # type: ignore
-                    if term_exists(str(getattr(frame,"text")), terms, args.case):
-                        to_delete.append(tag)
-
-            if (len(to_delete) > 0) or (len(to_modify) > 0):
-                for tag in to_modify:
-                    frame = id3file[tag]
-                    text = getattr(frame,"text")
-                    if len(text) > 0:
-                        text = text[0] 
-                        for term in terms:
-                            itext = re.compile(re.escape(term), re.IGNORECASE)
-                            text = itext.sub("", text).strip()
-                        text = text.replace("  "," ")
-                        setattr(frame, "text", text)
-                        output_str += " " + id3file[tag].FrameID
-
-                for tag in to_delete:
+                text = getattr(frame,"text")
+                if len(text) > 0:
+                    text = text[0] 
+                    for term in terms:
+                        itext = re.compile(re.escape(term), re.IGNORECASE)
+                        text = itext.sub("", text).strip()
+                    text = text.replace("  "," ")
+                    setattr(frame, "text", text)
                     output_str += " " + id3file[tag].FrameID
-                    del id3file[tag]
-                if not args.dryrun:
-                    id3file.save()
-                print(output_str)
+
+            for tag in to_delete:
+                output_str += " " + id3file[tag].FrameID
+                del id3file[tag]
+            if not args.dryrun:
+                if writer.save(id3file):
+                    output_str += " (rewritten)"
+            print(output_str)
+
+    if not args.dryrun:
+        print(writer.summary())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,10 @@
+'''
+file_sizes - Formats byte counts for the summaries the scripts print
+'''
+
+from math import floor, log
+
+def format_bytes(size) -> str:
+    '''Returns size with the largest unit that keeps it at least 1, e.g. "1.5 GB".'''
+    power = 0 if size <= 0 else floor(log(size, 1024))
+    return f"{round(size / 1024 ** power, 2)} {['B', 'KB', 'MB', 'GB', 'TB'][int(power)]}"
@@ -9,16 +9,8 @@ from unidecode import unidecode
 from ffmpeg import FFmpeg
 import mutagen
 import mutagen.id3
-
-def get_ext(filename, tolower=False) -> str:
-    ext = ""
-    idx = filename.rfind('.')
-    if idx >= 0:
-        ext = filename[idx + 1:]
-    if tolower:
-        return ext.lower()
-    else:
-        return ext
+from media_scanner import find_media
+from tag_writer import TagWriter
 
 '''
 extractPairedCharacters - Removes strings that are bounded by parentheses, brackets, etc.
@@ -103,26 +95,9 @@ def main():
 
     extensions = ["flac","mkv","mp3","m4a","m4b","lrc"]
 
-    mediafiles = list()
-    if os.path.isdir(args.input):
-        for root, dirs, files in os.walk(args.input):
-            for file in files:
-                filename = str(file)
-                if get_ext(filename, tolower=True) in extensions:
-                    mediafiles.append(os.path.join(root, file))
-    else:
-        filename = str(args.input)
-        if get_ext(filename, tolower=True) in extensions:
-            mediafiles.append(args.input)
-        else:
-            print("%s is not a supported media file type" % args.input)
-    mediafiles.sort()
-    
-    if len(mediafiles) == 0:
-        print("No files to process")
-        return
+    mediafiles = find_media(args.input, extensions)
+    writer = TagWriter()
 
-    total = len(mediafiles)
     for mediafile in mediafiles:
         head,tail = os.path.split(mediafile)
         idx = tail.rfind('.')
@@ -161,18 +136,18 @@ def main():
             try:
                 id3file = mutagen.id3.ID3(newfilename)
                 if id3file is not None:
-                    for tag in filter(lambda t: t.startswith(("")), id3file):
-                        frame = id3file[tag]
-                        if isinstance(frame, mutagen.id3.TIT2): # type: ignore
-                            text = getattr(frame,"text")
-                            if len(text) > 0:
-                                ret = str(text[0])
-                                ret = stripStrings(ret, 0)
-                                if ret != text:
-                                    setattr(frame, "text", ret)
-                                    id3file.save()
-                                    break
+                    frame = id3file.get("TIT2")
+                    if frame is not None:
+                        text = getattr(frame,"text")
+                        if len(text) > 0:
+                            ret = str(text[0])
+                            ret = stripStrings(ret, 0)
+                            if ret != str(text[0]):
+                                setattr(frame, "text", ret)
+                                writer.save(id3file)
             except:
                 pass # not an MP3 file
+    if writer.in_place + writer.rewritten > 0:
+        print(writer.summary())
 if __name__ == '__main__':
     main()
@@ -9,6 +9,7 @@ from unidecode import unidecode
 from ffmpeg import FFmpeg
 import mutagen
 import mutagen.id3
+from media_scanner import find_media
 
 def replace_unicode(input:str) -> str:
     ret = input
@@ -28,16 +29,6 @@ def is_number(s):
         return False
     else:  # Succeeded
         return True
-    
-def get_ext(filename, tolower=False) -> str:
-    ext = ""
-    idx = filename.rfind('.')
-    if idx >= 0:
-        ext = filename[idx + 1:]
-    if tolower:
-        return ext.lower()
-    else:
-        return ext
 
 def main():
     parser = argparse.ArgumentParser(description='Convert FLAC files to mp3')
@@ -52,28 +43,12 @@ def main():
 
     extensions = ["flac","mkv","mp3","m4a","m4b"]
 
-    mediafiles = list()
-    if os.path.isdir(args.input):
-        for root, dirs, files in os.walk(args.input):
-            for file in files:
-                filename = str(file)
-                if get_ext(filename, tolower=True) in extensions:
-                    mediafiles.append(os.path.join(root, file))
-    else:
-        filename = str(args.input)
-        if get_ext(filename, tolower=True) in extensions:
-            mediafiles.append(args.input)
-        else:
-            print("%s is not a supported media file type" % args.input)
-    mediafiles.sort()
-    
-    if len(mediafiles) == 0:
-        print("No files to process")
-        return
+    mediafiles = find_media(args.input, extensions)
 
-    total = len(mediafiles)
+    total = 0
     with open(args.output, mode="wt", encoding="utf-8") as file:
         for mediafile in mediafiles:
+            total += 1
             head,tail = os.path.split(mediafile)
             idx = tail.rfind('.')
             if idx == -1:
@@ -121,5 +96,8 @@ def main():
             file.write("eyed3 \"%s\" -a \"%s\" -b \"%s\" -t \"%s\"\n" % (mediafile, artist, artist, title))
             file.write("REN \"%s\" \"%s\"\n" % (mediafile, ret))
 
+    if total == 0:
+        print("No files to process")
+
 if __name__ == '__main__':
     main()
@@ -9,27 +9,128 @@ downsample to whatever it chooses.
 '''
 
 import os
+import json
 import argparse
 from pathlib import Path
 from timeit import default_timer as timer
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from ffmpeg import FFmpeg
+from mutagen.flac import FLAC
+from media_scanner import find_media
+from file_sizes import format_bytes
+from media_tags import load_id3, first_text
+
+# TXXX description of the frame in each MP3 recording which source and settings it came from
+FINGERPRINT_DESC = "source_fingerprint"
+
+def get_fingerprint(mediafile:str, st:os.stat_result, bitrate:int) -> str:
+    '''
+    Identifies the source audio and the settings used to encode it. FLAC files carry an MD5 of
+    the decoded audio in STREAMINFO, which doesn't change when only the FLAC's tags are edited.
+    Otherwise (mkv, or a FLAC encoder that left the MD5 empty) the size and mtime are used.
+    '''
+    md5 = 0
+    try:
+        md5 = FLAC(mediafile).info.md5_signature # type: ignore
+    except Exception:
+        pass
+    if md5 != 0:
+        return "md5=%032x;bitrate=%d" % (md5, bitrate)
+    return "size=%d;mtime=%d;bitrate=%d" % (st.st_size, st.st_mtime_ns, bitrate)
+
+def read_fingerprint(outputfilename:str) -> str:
+    try:
+        tags = load_id3(outputfilename)
+    except Exception:
+        return ""
+    if tags is None:
+        return ""
+    return first_text(tags.get("TXXX:" + FINGERPRINT_DESC))
+
+# Suffix of the file ffmpeg writes to. It is renamed to the .mp3 only once the conversion
+# succeeded, so an .mp3 that exists is always complete.
+PART_SUFFIX = ".part"
+
+class Journal:
+    '''
+    Append-only log (JSON lines) of finished conversions, with the size and modification time
+    of each source. After a crash or reboot, sources that converted successfully and haven't
+    changed since are skipped, even with --overwrite.
+    '''
+    def __init__(self, filename:str, fresh:bool=False):
+        self.filename = filename
+        self.entries = dict()
+        if not fresh and os.path.exists(filename):
+            with open(filename, mode="rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry["path"]] = entry
+                    except (ValueError, KeyError):
+                        continue # a line cut short by the crash
+        self.fh = open(filename, mode="wt" if fresh else "at", encoding="utf-8")
+
+    def is_done(self, mediafile:str, outputfilename:str, bitrate:int) -> bool:
+        entry = self.entries.get(os.path.abspath(mediafile))
+        if entry is None or entry["status"] != "done" or not os.path.exists(outputfilename):
+            return False
+        st = os.stat(mediafile)
+        return entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns and entry.get("bitrate") == bitrate
+
+    def record(self, mediafile:str, st:os.stat_result, bitrate:int, status:str, error:str=""):
+        entry = {"path": os.path.abspath(mediafile), "size": st.st_size, "mtime": st.st_mtime_ns, "bitrate": bitrate, "status": status}
+        if len(error) > 0:
+            entry["error"] = error
+        self.entries[entry["path"]] = entry
+        self.fh.write(json.dumps(entry) + "\n")
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        self.fh.close()
+
+def convert(mediafile:str, outputfilename:str, output_options:dict):
+    '''
+    Runs one ffmpeg conversion into a temporary file and renames it to outputfilename when
+    ffmpeg succeeds. Returns the wall clock seconds it took and the seconds of audio converted
+    (the last time ffmpeg reported progress for). Raises on failure.
+    '''
+    audio = [0.0]
+    partfilename = outputfilename + PART_SUFFIX
+    # The temporary file is ours, so it's always overwritten (e.g. left over from a crash)
+    ffmpeg = (FFmpeg()
+        .option('y')
+        .input(mediafile)
+        .output(
+            partfilename,
+            output_options
+        )
+    )
+
+    @ffmpeg.on("progress")
+    def on_progress(progress):
+        audio[0] = progress.time.total_seconds()
+
+    start = timer()
+    try:
+        ffmpeg.execute()
+        os.replace(partfilename, outputfilename)
+    except:
+        if os.path.exists(partfilename):
+            os.remove(partfilename)
+        raise
+    return timer() - start, audio[0]
 
-def get_ext(filename, tolower=False) -> str:
-    ext = ""
-    idx = filename.rfind('.')
-    if idx >= 0:
-        ext = filename[idx + 1:]
-    if tolower:
-        return ext.lower()
-    else:
-        return ext
-    
 def main():
     parser = argparse.ArgumentParser(description='Convert FLAC files to mp3')
     parser.add_argument('input', help='Media file or a folder of media files')
-    parser.add_argument("-b", "--bitrate", help="Bitrate (default = 320)", default=320)
+    parser.add_argument("-b", "--bitrate", help="Bitrate (default = 320)", default=320, type=int)
     parser.add_argument("-o", "--overwrite", help="Overwrite output?", action="store_true", default=False)
     parser.add_argument("-d", "--delete", help="Delete FLAC on successful conversion?", action="store_true", default=False)
+    parser.add_argument("-j", "--jobs", help="Number of conversions to run at once (default: 1)", default=1, type=int)
+    parser.add_argument("-u", "--update", help="Re-encode existing output only if the source or bitrate changed", action="store_true", default=False)
+    parser.add_argument("--journal", help="Journal of finished conversions (default: flac-to-mp3.journal)", default="flac-to-mp3.journal")
+    parser.add_argument("--fresh", help="Ignore and clear the journal from previous runs", action="store_true", default=False)
 
     args = parser.parse_args()
 
@@ -39,32 +140,19 @@ def main():
 
     extensions = ["flac","mkv"]
 
-    mediafiles = list()
-    if os.path.isdir(args.input):
-        for root, dirs, files in os.walk(args.input):
-            for file in files:
-                filename = str(file)
-                if get_ext(filename, tolower=True) in extensions:
-                    mediafiles.append(os.path.join(root, file))
-    else:
-        filename = str(args.input)
-        if get_ext(filename, tolower=True) in extensions:
-            mediafiles.append(args.input)
-        else:
-            print("%s is not a supported media file type" % args.input)
-    mediafiles.sort()
-    
-    if len(mediafiles) == 0:
-        print("No files to process")
-        return
+    mediafiles = find_media(args.input, extensions)
 
     # Copy the metadata from the source material. Generate ID3v2.3 (although 2.4 is better)
-    output_options = {'map_metadata':'0', 'id3v2_version':'3', 'ab':'%dk' % (args.bitrate)}
-    overwrite = 'n'
-    if args.overwrite:
-        overwrite = 'y'
+    # The format is given because ffmpeg can't tell it from the temporary file's name.
+    output_options = {'map_metadata':'0', 'id3v2_version':'3', 'ab':'%dk' % (args.bitrate), 'f':'mp3'}
+
+    journal = Journal(args.journal, args.fresh)
+
+    # Each ffmpeg process uses one core for an MP3 encode, so --jobs runs several at once.
+    # The threads only wait on the ffmpeg processes.
+    pool = ThreadPoolExecutor(max_workers=max(1, args.jobs))
+    futures = dict()
 
-    total = len(mediafiles)
     i = 1
     start = timer()
     for mediafile in mediafiles:
@@ -88,29 +176,66 @@ def main():
             print("Cue file exists for %s. Skipping. Try\n ffcuesplitter -i \"%s\" -f mp3 -o \"%s\"" % (mediafile, cuefilename, mediafile[:idx]))
             continue
         
-        print("%d/%d: %s" % (i, total, mediafile))
         i += 1
 
-        if os.path.exists(outputfilename) and not args.overwrite:
-            print('Output file exists: %s' % (outputfilename))
-        else:
-            try:
-                ffmpeg = (FFmpeg()
-                    .option(overwrite)
-                    .input(mediafile)
-                    .output(
-                        outputfilename,
-                        output_options
-                    )
-                ) 
-                ffmpeg.execute()
-            except Exception as e:
-                print("Error converting %s: %s" % (mediafile, e))
-            else:
-                if args.delete:
-                    os.remove(mediafile)
+        if journal.is_done(mediafile, outputfilename, args.bitrate):
+            print('Already converted: %s' % (mediafile))
+            continue
+
+        # Every output is stamped with the fingerprint of its source, so --update can tell
+        # whether an existing MP3 is still current without decoding anything.
+        st = os.stat(mediafile)
+        fingerprint = get_fingerprint(mediafile, st, args.bitrate)
+        if os.path.exists(outputfilename):
+            if args.update:
+                if read_fingerprint(outputfilename) == fingerprint:
+                    print('Up to date: %s' % (outputfilename))
+                    continue
+            elif not args.overwrite:
+                print('Output file exists: %s' % (outputfilename))
+                continue
+
+        options = dict(output_options)
+        options['metadata'] = "%s=%s" % (FINGERPRINT_DESC, fingerprint)
+        future = pool.submit(convert, mediafile, outputfilename, options)
+        futures[future] = (mediafile, st)
+
+    if i == 1:
+        print("No files to process")
+        journal.close()
+        return
+
+    # Report each conversion as it finishes. The source is only deleted after its own
+    # conversion succeeded.
+    total = len(futures)
+    done = 0
+    total_bytes = 0
+    total_audio = 0.0
+    failed = 0
+    for future in as_completed(futures):
+        mediafile, st = futures[future]
+        done += 1
+        try:
+            seconds, audio = future.result()
+        except Exception as e:
+            failed += 1
+            journal.record(mediafile, st, args.bitrate, "failed", str(e))
+            print("%d/%d: Error converting %s: %s" % (done, total, mediafile, e))
+            continue
+
+        journal.record(mediafile, st, args.bitrate, "done")
+        total_bytes += st.st_size
+        total_audio += audio
+        print("%d/%d: %s (%.1f s, %.1fx realtime)" % (done, total, mediafile, seconds, audio / max(seconds, 0.001)))
+        if args.delete:
+            os.remove(mediafile)
+    pool.shutdown()
+    journal.close()
+
     end = timer()
-    print("Duration: %10.2d" % (end - start))
+    elapsed = max(end - start, 0.001)
+    print("Duration: %10.2f s" % (elapsed))
+    print("Converted %d files (%d failed), %s at %.2f MB/s, %.1fx realtime" % (done - failed, failed, format_bytes(total_bytes), total_bytes / elapsed / (1024 * 1024), total_audio / elapsed))
 
 if __name__ == '__main__':
     main()
@@ -4,26 +4,72 @@ generate-metadata-list - Searches a file structure and extracts the metadata to
 '''
 
 import os
+import csv
 import argparse
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
 from unidecode import unidecode
-import mutagen
-from mutagen.mp3 import MP3
-from mutagen.mp3 import MPEGInfo
-from mutagen import mp3
 from colorama import Fore
+from media_scanner import find_media
+from media_tags import TrackTags, LENGTH_UNKNOWN, read_many
+from tag_cache import DEFAULT_CACHE, open_cache
+from library_index import from_rows, write_index
+
+# Files handed to a worker process at a time. Big enough to keep the pickling overhead
+# small, small enough that all the workers stay busy near the end of the scan.
+CHUNK_SIZE = 64
+
+def format_row(filepath:str, tags:TrackTags) -> str:
+    grouping = ""
+    if len(tags.grouping) > 0:
+        grouping = tags.grouping[0]
+    return "\"%s\",\"%s\",\"%s\",\"%s\",\"%s\",\"%d\",\"%d\",\"%d\",\"%s\",\"%d\"\n" % (filepath.replace("\"","\\\"").replace('\\','/'), tags.artist.replace("\"","\"\""), tags.album.replace("\"","\"\""), tags.title.replace("\"","\"\""), tags.genre.replace("\"","\"\""), tags.rating, tags.year, tags.length, grouping, tags.filesize)
+
+HEADER = "\"Path\",\"Artist\",\"Album\",\"Title\",\"Genre\",\"Rating\",\"Year\",\"Length\",\"Grouping\",\"File Size\"\n"
+
+def get_settings(args) -> str:
+    # Anything that changes which rows are written or how paths look. If these differ from the
+    # previous run, an incremental update isn't possible and the list is rebuilt.
+    return "zero=%s|extractprefix=%s|prefix=%s" % (args.zero, args.extractprefix, args.prefix)
+
+def load_previous(output:str, state_file:str, settings:str):
+    '''
+    Reads the previous list and its state file. Returns the stat data of each media file seen
+    on the previous run (size, mtime, whether it has a row) and the previous rows by path.
+    Both are empty if the previous run can't be reused.
+    '''
+    previous = dict()
+    previous_lines = dict()
+    try:
+        with open(state_file, mode="rt", encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None or len(header) < 2 or header[1] != settings:
+                print("Settings changed since the last run, rebuilding %s" % (output))
+                return dict(), dict()
+            for line in reader:
+                previous[line[0]] = (int(line[1]), int(line[2]), line[3] == "1")
+
+        with open(output, mode="rt", encoding="utf-8") as f:
+            for line in f:
+                if line == HEADER:
+                    continue
+                row = next(csv.reader([line]), None)
+                if row is not None and len(row) > 0:
+                    previous_lines[row[0]] = line
+    except (OSError, ValueError, IndexError) as e:
+        print("Can't use previous run (%s), rebuilding %s" % (e, output))
+        return dict(), dict()
+    return previous, previous_lines
+
+def write_state(state_file:str, settings:str, state:list):
+    with open(state_file, mode="wt", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["#settings", settings])
+        for item in sorted(state):
+            writer.writerow(item)
 
-# get_ext - check that the file extension is supported
-def get_ext(filename, tolower=False) -> str:
-    ext = ""
-    idx = filename.rfind('.')
-    if idx >= 0:
-        ext = filename[idx + 1:]
-    if tolower:
-        return ext.lower()
-    else:
-        return ext
-    
 def main():
     parser = argparse.ArgumentParser(description='Group and rate media files with ID3 tags')
     parser.add_argument('input', help='Media file or a folder of media files')
@@ -32,6 +78,12 @@ def main():
     parser.add_argument("-p", "--prefix", help="Prefix to add from path names")
     parser.add_argument("-v", "--verbose", help="Be verbose (default: False)", action="store_true", default=False)
     parser.add_argument("-z", "--zero", help="Output files with 0 rating (default: False)", action="store_true", default=False)
+    parser.add_argument("-e", "--exclude", action="append", help="File or folder name pattern to skip (e.g. Playlists, *.tmp)")
+    parser.add_argument("-c", "--cache", help="Tag cache file (default: %s)" % (DEFAULT_CACHE), default=DEFAULT_CACHE)
+    parser.add_argument("--no-cache", help="Read every file, don't use the tag cache", action="store_true", default=False)
+    parser.add_argument("-j", "--jobs", help="Number of processes reading tags (default: 1)", default=1, type=int)
+    parser.add_argument("--index", help="Also write the list as a binary index file (e.g. ratings-list.idx) that loads faster")
+    parser.add_argument("-i", "--incremental", help="Only read files added or changed since the last run (default: False)", action="store_true", default=False)
 
     args = parser.parse_args()
 
@@ -44,34 +96,70 @@ def main():
     extensions = ["mp3","m4a","m4b"] # TODO: Add m4a, m4b, flac, etc.
 
     # Search input directory for files with the matching extension or if a single file,
-    # Make sure it's the supported extension(s)
-    mediafiles = list()
-    if os.path.isdir(args.input):
-        for root, dirs, files in os.walk(args.input):
-            for file in files:
-                filename = str(file)
-                if get_ext(filename, tolower=True) in extensions:
-                    mediafiles.append(os.path.join(root, file))
-    else:
-        filename = str(args.input)
-        if get_ext(filename, tolower=True) in extensions:
-            mediafiles.append(args.input)
-        else:
-            print("%s is not a supported media file type" % args.input)
-
-    # For convenience sake, sort the list of found media files by path, in case os.walk() didn't
-    mediafiles.sort()
-    
-    if len(mediafiles) == 0:
-        print("No files to process")
-        return
-
-    outfile = open(args.output, "wt", encoding="utf-8")
-    outfile.write("\"Path\",\"Artist\",\"Album\",\"Title\",\"Genre\",\"Rating\",\"Year\",\"Length\",\"Grouping\",\"File Size\"\n")
-
-    total = len(mediafiles)
+    # Make sure it's the supported extension(s). The scanner streams files as it finds
+    # them, so parsing starts while the rest of the library is still being walked.
+    mediafiles = find_media(args.input, extensions, exclude=args.exclude)
+
+    # Unchanged files are served from the tag cache, so only new or edited files are opened
+    cache = None
+    if not args.no_cache:
+        cache = open_cache(args.cache)
+
+    # The state file records the size and modification time of every file seen, so the
+    # next --incremental run can reuse the rows of files that haven't changed.
+    settings = get_settings(args)
+    state_file = args.output + ".state"
+    previous = dict()
+    previous_lines = dict()
+    if args.incremental:
+        previous, previous_lines = load_previous(args.output, state_file, settings)
+
+    # Rows are collected and sorted by media file path before writing, so the output
+    # doesn't depend on the order the scanner visited the folders
+    lines = list()
+    state = list()
+    unchanged = 0
+    changed = 0
+    added = 0
     i = 0
+    read = 0
     printed = ""
+
+    def add_row(mediafile, filepath, st, tags):
+        emitted = tags.rating > 0 or args.zero
+        if emitted:
+            if tags.year == 0:
+                print("%s: Year is 0" % (mediafile))
+            lines.append((mediafile, format_row(filepath, tags)))
+        state.append((mediafile, st.st_size, st.st_mtime_ns, "1" if emitted else "0"))
+
+    def add_chunk(chunk, results):
+        for (mediafile, filepath, st), (tags, error) in zip(chunk, results):
+            if error is not None:
+                print(error)
+                continue
+            if cache is not None:
+                cache.put(mediafile, st, tags)
+            add_row(mediafile, filepath, st, tags)
+
+    # Files that aren't in the cache are read in chunks. With --jobs the chunks go to a
+    # process pool while this process keeps scanning, checking the cache and collecting.
+    pool = None
+    if args.jobs > 1:
+        pool = ProcessPoolExecutor(max_workers=args.jobs)
+    submitted = list()
+    chunk = list()
+
+    def submit(chunk):
+        if len(chunk) == 0:
+            return
+        paths = [item[0] for item in chunk]
+        if pool is None:
+            add_chunk(chunk, read_many(paths))
+        else:
+            submitted.append((chunk, pool.submit(read_many, paths)))
+
+    start = timer()
     for mediafile in mediafiles:
         filepath = str(mediafile.replace("\\","/"))
         if (args.extractprefix):
@@ -87,97 +175,74 @@ def main():
         head,tail = os.path.split(Path(mediafile))
         if args.verbose:
             if head != printed:
-                print(Fore.GREEN + "%d/%d: %s" % (i, total, head) + Fore.BLACK)
+                print(Fore.GREEN + "%d: %s" % (i, head) + Fore.BLACK)
                 printed = head
         try:
-            # id3file = mutagen.id3.ID3(mediafile)
-            mp3file = MP3(mediafile)
-            if mp3file is not None:
-                rating = 0
-                year = 0
-                length = int(((mp3file.info.length * 1000) + 1000)/1000)
-                filesize = os.path.getsize(mediafile)
-                title = ""
-                genre = ""
-                artist = ""
-                grouping = ""
-                album = ""
-                tags = getattr(mp3file, "tags")
-                for tag in filter(lambda t: t.startswith(("")), tags):
-                    frame = tags[tag]
-                    if isinstance(frame, mutagen.id3.POPM): # type: ignore
-                        rating = getattr(frame, "rating")
-                    elif isinstance(frame, mutagen.id3.TXXX): # type: ignore
-                        key = getattr(frame, "desc")
-                        if key == "originalyear":
-                            tmp = getattr(frame, "text")
-                            if len(tmp) > 0:
-                                # if year == 0:
-                                year = str(tmp[0]).strip()
-                                if len(year) > 4:
-                                    print("%s: Year shortened to %s" % (mediafile, year))
-                                    year = year[0:4]
-                                year = int(year)
-                                # else:
-                                #     if int(tmp[0]) != year and args.verbose:
-                                #         print("Conflicting dates for %s (%s, %d)" % (mediafile, tmp[0], year))
-                    elif isinstance(frame, mutagen.id3.TIT2): # type: ignore
-                        tmp = getattr(frame, "text")
-                        if len(tmp) > 0:
-                            title = tmp[0]
-                    elif isinstance(frame, mutagen.id3.TALB): # type: ignore
-                        tmp = getattr(frame, "text")
-                        if len(tmp) > 0:
-                            album = tmp[0]
-                    elif isinstance(frame, mutagen.id3.TDRC): # type: ignore
-                        # Choosing to prioritize the text frame originalyear over
-                        # this if both exist. While this field is likely to be more
-                        # accurate historically, I deliberately want each album to
-                        # have the same year for each track so that Navidrome
-                        # doesn't show multiple albums differentiated only by year.
-                        if year == 0:
-                            tmp = getattr(frame, "text")
-                            if len(tmp) > 0:
-                                if year == 0:
-                                    year = str(tmp[0])
-                                    # MBZ puts in YYYY-MM-DD if it's available. I just want the year
-                                    if len(year) > 4:
-                                        year = year[0:4]
-                                        print("%s: Year shortened to %s" % (mediafile, year))
-                                    year = int(year)
-                            # else:
-                            #     if int(tmp[0]) != year and args.verbose:
-                            #         print("Conflicting dates for %s (%s, %d)" % (mediafile, tmp[0], year))
-                    elif isinstance(frame, mutagen.id3.TPE1): # type: ignore
-                        tmp = getattr(frame, "text")
-                        if len(tmp) > 0:
-                            artist = tmp[0]
-                    elif isinstance(frame, mutagen.id3.TCON): # type: ignore
-                        tmp = getattr(frame, "genres")
-                        if len(tmp) > 0:
-                            genre = tmp[0]
-                    elif isinstance(frame, mutagen.id3.TCON): # type: ignore
-                        tmp = getattr(frame, "genres")
-                        if len(tmp) > 0:
-                            genre = tmp[0]
-                    elif isinstance(frame, mutagen.id3.GRP1): # type: ignore
-                        tmp = getattr(frame, "text")
-                        if len(tmp) > 0:
-                            grouping = tmp[0]
-
-                if rating > 0 or args.zero:
-                    if year == 0:
-                        print("%s: Year is 0" % (mediafile))
-                    outfile.write("\"%s\",\"%s\",\"%s\",\"%s\",\"%s\",\"%d\",\"%d\",\"%d\",\"%s\",\"%d\"\n" % (filepath.replace("\"","\\\"").replace('\\','/'), artist.replace("\"","\"\""), album.replace("\"","\"\""), title.replace("\"","\"\""), genre.replace("\"","\"\""), rating, year, length, grouping, filesize))
-            else:
-                print("Can't find necessary ID3 tags for %s" % (mediafile))
+            st = os.stat(mediafile)
+        except OSError as e:
+            print("%s: %s" % (mediafile, e))
+            continue
+
+        old = previous.pop(mediafile, None)
+        if old is not None and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+            line = previous_lines.get(filepath)
+            if not old[2] or line is not None:
+                if old[2]:
+                    lines.append((mediafile, line))
+                state.append((mediafile, st.st_size, st.st_mtime_ns, "1" if old[2] else "0"))
+                unchanged += 1
                 continue
 
-        except Exception as e:
-            print(e)
-            continue
+        if old is None:
+            added += 1
+        else:
+            changed += 1
+
+        # Entries cached by a tag-only reader have no length yet, so read those again
+        if cache is not None:
+            tags = cache.get(mediafile, st)
+            if tags is not None and tags.length != LENGTH_UNKNOWN:
+                add_row(mediafile, filepath, st, tags)
+                continue
+
+        read += 1
+        chunk.append((mediafile, filepath, st))
+        if len(chunk) >= CHUNK_SIZE:
+            submit(chunk)
+            chunk = list()
+    submit(chunk)
+
+    if pool is not None:
+        for chunk, future in submitted:
+            add_chunk(chunk, future.result())
+        pool.shutdown()
+    end = timer()
+
+    if cache is not None:
+        if args.verbose:
+            print(Fore.GREEN + "Tag cache: %d unchanged, %d read" % (cache.hits, cache.misses) + Fore.BLACK)
+        cache.close()
 
+    if i == 0:
+        print("No files to process")
+        return
+
+    elapsed = max(end - start, 0.001)
+    print("%d files in %.2f s (%.1f files/sec), %d read from disk (%.1f files/sec)" % (i, elapsed, i / elapsed, read, read / elapsed))
+    if args.incremental:
+        print("%d unchanged, %d changed, %d added, %d removed" % (unchanged, changed, added, len(previous)))
+
+    lines.sort()
+    outfile = open(args.output, "wt", encoding="utf-8")
+    outfile.write(HEADER)
+    for mediafile, line in lines:
+        outfile.write(line)
     outfile.close()  
+    write_state(state_file, settings, state)
+
+    # The same rows in columns, for the scripts that read the list (see library_index.py)
+    if args.index is not None:
+        write_index(args.index, from_rows(csv.reader(line for mediafile, line in lines)))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
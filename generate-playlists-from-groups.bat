@@ -1,6 +1 @@
-python E:\Music\Scripts\group-actions.py E:\Music print -l E:\Music\Scripts\ratings-list.txt -f m3u -t am-gold        -p "AM Gold"        -o am-gold.m3u
-python E:\Music\Scripts\group-actions.py E:\Music print -l E:\Music\Scripts\ratings-list.txt -f m3u -t angies-country -p "Angies Favorite Country" -o angies-country.m3u
-python E:\Music\Scripts\group-actions.py E:\Music print -l E:\Music\Scripts\ratings-list.txt -f m3u -t classic-rock   -p "Classic Rock"   -o classic-rock.m3u
-python E:\Music\Scripts\group-actions.py E:\Music print -l E:\Music\Scripts\ratings-list.txt -f m3u -t sunday-morning -p "Easy Like Sunday Morning" -o sunday-morning.m3u
-python E:\Music\Scripts\group-actions.py E:\Music print -l E:\Music\Scripts\ratings-list.txt -f m3u -t outlaw-country -p "Outlaw Country" -o outlaw-country.m3u
-python E:\Music\Scripts\group-actions.py E:\Music print -l E:\Music\Scripts\ratings-list.txt -f m3u -t world-music    -p "World Music"    -o world-music.m3u
+python E:\Music\Scripts\group-actions.py E:\Music print -l E:\Music\Scripts\ratings-list.txt -f m3u -s E:\Music\Scripts\playlists-from-groups.csv
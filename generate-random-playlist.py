@@ -6,7 +6,11 @@ import argparse
 from pathlib import Path
 import random
 import csv
+import math
+import time
+import heapq
 from datetime import datetime
+from library_index import load_library
 
 # Source - https://stackoverflow.com/a/354130
 # Posted by S.Lott, modified by community. See post 'Timeline' for change history
@@ -20,9 +24,94 @@ def is_number(s):
     else:  # Succeeded
         return True
 
+def recording_from_row(line:list) -> dict:
+    return {
+        "path":line[0],
+        "artist": line[1],
+        "album": line[2],
+        "title": line[3],
+        "genre": line[4],
+        "rating": int(line[5]),
+        "year": int(line[6]),
+        "length": int(line[7]),
+        "grouping": line[8]
+    }
+
+def select_rows(library, artists, genres, years, rating:int, require_all:bool) -> list:
+    '''
+    Returns the numbers of the rows matching the criteria, in list order. Each criterion is
+    evaluated over its whole column into a set of rows, then the sets are intersected (--all)
+    or joined (any). With no criteria every row is selected. The rating is a minimum that
+    applies either way.
+    '''
+    criteria = []
+    if artists is not None and len(artists) > 0:
+        criteria.append(library.rows_in("artist", artists))
+    if genres is not None and len(genres) > 0:
+        criteria.append(library.rows_in("genre", genres))
+    if len(years) > 0:
+        criteria.append(library.rows_in("year", years))
+
+    if len(criteria) == 0:
+        selected = set(range(len(library)))
+    elif require_all:
+        selected = set.intersection(*criteria)
+    else:
+        selected = set.union(*criteria)
+    if rating > 0:
+        selected &= library.rows_where("rating", lambda value: value >= rating)
+    return sorted(selected)
+
+# With --history, a song picked for an earlier playlist starts again with almost no weight and
+# gets back half its weight after this many days
+DEFAULT_DECAY_DAYS = 14.0
+
+# No song's weight goes below this, so a song picked a moment ago is unlikely to be picked again
+# but can still fill a playlist when there aren't enough other songs
+MIN_WEIGHT = 0.01
+
+def load_history(filename:str) -> dict:
+    '''Returns when each song was last picked (seconds since the epoch), by path.'''
+    history = dict()
+    try:
+        with open(filename, mode="rt", encoding="utf-8", newline="") as f:
+            for line in csv.reader(f):
+                if len(line) >= 2:
+                    history[line[0]] = float(line[1])
+    except FileNotFoundError:
+        pass
+    return history
+
+def save_history(filename:str, history:dict, now:float, decay_days:float):
+    # Songs that have got back nearly all their weight (10 half lives) are dropped, so the
+    # file doesn't grow forever
+    keep = now - decay_days * 10 * 24 * 60 * 60
+    with open(filename, mode="wt", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        for path, picked in sorted(history.items()):
+            if picked >= keep:
+                writer.writerow([path, "%.0f" % (picked)])
+
+def song_weight(rating:int, picked, now:float, decay_days:float) -> float:
+    # Unrated songs get the smallest weight rather than none
+    weight = float(max(rating, 1))
+    if picked is not None and decay_days > 0:
+        days = max(now - picked, 0) / (24 * 60 * 60)
+        weight *= 1.0 - 0.5 ** (days / decay_days)
+    return max(weight, MIN_WEIGHT)
+
+def weighted_sample(rng:random.Random, candidates:list, weights:list, k:int) -> list:
+    '''
+    Picks k of the candidates without repeats, each with probability proportional to its
+    weight (Efraimidis-Spirakis): every candidate gets the key log(u)/weight for a uniform
+    random u and the k largest keys win. One pass over the candidates, O(n log k).
+    '''
+    keys = ((math.log(1.0 - rng.random()) / weight, i) for i, weight in zip(candidates, weights) if weight > 0)
+    return [i for key, i in heapq.nlargest(k, keys)]
+
 def main():
     parser = argparse.ArgumentParser(description='Generate a playlist of random songs based on year, genre, rating.')
-    parser.add_argument('-l','--list', help='List of all files', required=True)
+    parser.add_argument('-l','--list', help='List of all files from generate-metadata-list (CSV or --index file)', required=True)
     parser.add_argument('-o','--output', help='Output File', required=True)
     parser.add_argument('-p','--playlist', help='Playlist title')
     parser.add_argument("-a", "--artist", action="append", help="Artist(s) to use to create list")
@@ -30,6 +119,10 @@ def main():
     parser.add_argument("-y", "--year", action="append", help="Year(s) to use to create list")
     parser.add_argument("-r", "--rating", help="Minimum rating (0-255) to filter", default=0, type=int)
     parser.add_argument("-n", "--number", help="Number of entries to generate", default=100, type=int)
+    parser.add_argument("-s", "--seed", help="Random seed, to generate the same playlist again", type=int)
+    parser.add_argument("-w", "--weighted", help="Pick higher rated songs more often (default: False)", action="store_true", default=False)
+    parser.add_argument("--history", help="File of songs picked before. With --weighted, recently picked songs are less likely to be picked again")
+    parser.add_argument("--decay", help="Days for a picked song to get back half its weight (default: %.0f)" % (DEFAULT_DECAY_DAYS), default=DEFAULT_DECAY_DAYS, type=float)
     parser.add_argument("--all", help="Require all criteria (default: any)", action="store_true", default=False)
     parser.add_argument("-v", "--verbose", help="Be verbose (default: False)", action="store_true", default=False)
 
@@ -68,75 +161,26 @@ def main():
                     return
                 years.append(year)
                 
-    recordings = []
-    with open(args.list,'rt',encoding="utf-8") as f:  
-        reader = csv.reader(f) 
-        for line in reader:
-            recording = {
-                "path":line[0],
-                "artist": line[1],
-                "album": line[2],
-                "title": line[3],
-                "genre": line[4],
-                "rating": int(line[5]),
-                "year": int(line[6]),
-                "length": int(line[7]),
-                "grouping": line[8]
-            }
-            if args.all:
-                add = True
-                if args.artist is not None:
-                    if len(args.artist) > 0:
-                        if recording["artist"] not in args.artist:
-                            add = False
-                if args.genre is not None:
-                    if len(args.genre) > 0:
-                        if recording["genre"] not in args.genre:
-                            add = False
-                if len(years) > 0:
-                    if recording["year"] not in years:
-                        add = False
-                if args.rating > 0:
-                    if recording["rating"] < args.rating:
-                        add = False
-                if add:
-                    recordings.append(recording)
-            else:
-                add = False
-                if args.artist is not None:
-                    if len(args.artist) > 0:
-                        if recording["artist"] in args.artist:
-                            add = True
-                elif args.genre is not None:
-                    if len(args.genre) > 0:
-                        if recording["genre"] in args.genre:
-                            add = True
-                elif len(years) > 0:
-                    if recording["year"] in args.year:
-                        add = True
-                elif args.rating > 0:
-                    if recording["rating"] >= args.rating:
-                        add = True
-
-                if add:
-                    recordings.append(recording)
-
-    count = len(recordings)
-    items = []
-    items_added = 1
-    while (items_added <= args.number) and (len(recordings) > 0):
-        idx = random.randrange(count)
-        recording = recordings[idx]
-        if args.rating > 0:
-            if recording["rating"] > args.rating:
-                items.append(recordings[idx])
-                items_added += 1
-            del recordings[idx]
-        else:
-            items.append(recordings[idx])
-            items_added += 1
-            del recordings[idx]
-        count -= 1
+    library = load_library(args.list)
+    candidates = select_rows(library, args.artist, args.genre, years, args.rating, args.all)
+
+    now = time.time()
+    history = dict()
+    if args.history is not None:
+        history = load_history(args.history)
+
+    # Every candidate already passed the filters, so pick the rows in one go, without repeats
+    rng = random.Random(args.seed)
+    if args.weighted:
+        ratings = library.columns["rating"]
+        paths = library.columns["path"]
+        weights = [song_weight(ratings[i], history.get(paths[i]) if len(history) > 0 else None, now, args.decay) for i in candidates]
+        picked = weighted_sample(rng, candidates, weights, args.number)
+    else:
+        picked = rng.sample(candidates, min(args.number, len(candidates)))
+    items = [recording_from_row(library.row(i)) for i in picked]
+    if args.verbose:
+        print("%d of %d songs matched, %d picked" % (len(candidates), len(library), len(items)))
 
     with open(args.output, mode="wt", encoding="utf-8") as file:
         file.write("#EXTM3U\n")
@@ -145,5 +189,10 @@ def main():
         for item in items:
             file.write("#EXTINF:%d, %s - %s\n" % (item["length"], item["artist"], item["title"]))
             file.write("%s\n" % (item["path"]))
+
+    if args.history is not None:
+        for item in items:
+            history[item["path"]] = now
+        save_history(args.history, history, now, args.decay)
 if __name__ == '__main__':
     main()
@@ -7,6 +7,7 @@ Does actions on the grouping (GRP1) tag based on user choices.
 
 import os
 import sys
+import shutil
 import argparse
 from pathlib import Path
 from unidecode import unidecode
@@ -14,14 +15,18 @@ import mutagen
 import mutagen.id3
 from mutagen.mp3 import MP3
 from colorama import Fore
+from media_scanner import find_media
+from file_sizes import format_bytes
+from media_tags import TrackTags, LENGTH_UNKNOWN, tags_from_id3, tags_from_mp3, load_id3
+from tag_cache import DEFAULT_CACHE, open_cache, load_tags
+from library_index import load_library
+from tag_writer import TagWriter
+import csv
+import json
+import itertools
 import datetime
 from enum import Enum
-from math import floor, log
-import csv
-
-def format_bytes(size):
-  power = 0 if size <= 0 else floor(log(size, 1024))
-  return f"{round(size / 1024 ** power, 2)} {['B', 'KB', 'MB', 'GB', 'TB'][int(power)]}"
+from concurrent.futures import ThreadPoolExecutor
 
 GROUP_SEPARATOR = "|"
 
@@ -40,37 +45,26 @@ class Recording:
         self.modified = False
     
     def fromMP3(self, mp3file:MP3):
-        self.length = int(((mp3file.info.length * 1000) + 1000)/1000)
-        self.path = mp3file.filename
-        self.filesize = os.path.getsize(self.path) # type: ignore
-        tags = getattr(mp3file, "tags")
-        if tags is not None:
-            for tag in filter(lambda t: t.startswith(("")), tags):
-                frame = tags[tag]
-                # TODO: Don't loop, just request specific frame types
-                if isinstance(frame, mutagen.id3.TALB): # type: ignore
-                    self.setAlbum(getattr(frame, "text"))
-                elif isinstance(frame, mutagen.id3.TPE1): # type: ignore
-                    self.setArtist(getattr(frame, "text"))
-                elif isinstance(frame, mutagen.id3.TIT2): # type: ignore
-                    self.setTitle(getattr(frame, "text"))
-                elif isinstance(frame, mutagen.id3.POPM): # type: ignore
-                    self.setRating(getattr(frame, "rating"))
-                elif isinstance(frame, mutagen.id3.GRP1) or isinstance(frame, mutagen.id3.GP1): # type: ignore
-                    self.setGrouping(getattr(frame, "text"))
-                elif isinstance(frame, mutagen.id3.TCON): # type: ignore
-                    self.setGenre(frame.genres)
-                elif isinstance(frame, mutagen.id3.TXXX): # type: ignore
-                    key = getattr(frame, "desc")
-                    if key == "originalyear":
-                        self.setYear(getattr(frame, "text"))
-                elif isinstance(frame, mutagen.id3.TDRC): # type: ignore
-                    # Choosing to prioritize the text frame originalyear over
-                    # this if both exist. While this field is likely to be more
-                    # accurate historically, I deliberately want each album to
-                    # have the same year for each track so that Navidrome
-                    # doesn't show multiple albums differentiated only by year.
-                    self.setYear(getattr(frame, "text"))
+        self.fromTags(tags_from_mp3(mp3file))
+        return
+
+    def fromID3(self, path:str, id3file):
+        # Tag only, the audio stream isn't read, so the length is unknown
+        tags = TrackTags(path=path, length=LENGTH_UNKNOWN, filesize=os.path.getsize(path))
+        self.fromTags(tags_from_id3(id3file, tags))
+        return
+
+    def fromTags(self, tags:TrackTags):
+        self.path = tags.path
+        self.artist = tags.artist
+        self.album = tags.album
+        self.title = tags.title
+        self.setGenre(tags.genres)
+        self.rating = tags.rating
+        self.year = tags.year
+        self.length = tags.length
+        self.setGrouping(tags.grouping)
+        self.filesize = tags.filesize
         self.modified = False
         return
     
@@ -147,8 +141,10 @@ class Recording:
                 tmp = value.split(GROUP_SEPARATOR)
                 if len(tmp) > 0:
                     for i in tmp:
-                        if not i in self.grouping:
+                        i = i.strip()
+                        if len(i) > 0 and not i in self.grouping:
                             self.grouping.add(i)
+                            self.modified = True
         return
 
     def fromList(self, line:list[str]):
@@ -173,38 +169,385 @@ class Recording:
         return
 
     def toList(self) -> list:
+        '''The reverse of fromList(), in the column order of the generate-metadata-list CSV.'''
         line = list()
-        line[0] = self.path
-        line[1] = self.artist
-        line[2] = self.album
-        line[3] = self.title
-        line[4] = GROUP_SEPARATOR.join(self.genre)
-        line[5] = str(self.rating)
-        line[6] = str(self.year)
-        line[7] = str(self.length)
-        line[8] = GROUP_SEPARATOR.join(self.grouping)
-        line[9] = str(self.filesize)
+        line.append(self.path)
+        line.append(self.artist)
+        line.append(self.album)
+        line.append(self.title)
+        line.append(GROUP_SEPARATOR.join(sorted(self.genre)))
+        line.append(str(self.rating))
+        line.append(str(self.year))
+        line.append(str(self.length))
+        line.append(GROUP_SEPARATOR.join(sorted(self.grouping)))
+        line.append(str(self.filesize))
         return line
 
+    def toDict(self) -> dict:
+        return {
+            "path": self.path,
+            "artist": self.artist,
+            "album": self.album,
+            "title": self.title,
+            "genre": sorted(self.genre),
+            "rating": self.rating,
+            "year": self.year,
+            "length": self.length,
+            "grouping": sorted(self.grouping),
+            "filesize": self.filesize
+        }
+
     def toString(self, format:str) -> str:
+        '''One recording in the txt, m3u/m3u8 or jsonl format. CSV is written by RecordingWriter.'''
         ret = ""
         if format == "txt":
             ret = "%s: %s" % (self.path, ", ".join(self.grouping))
-        elif format == "m3u":
+        elif format in ["m3u", "m3u8"]:
             ret = "#EXTINF:%d, %s - %s - %s\n%s" % (self.length, self.artist, self.album, self.title, self.path)
-        elif format == "csv":
-            ret = "\"%s\",\"%s\",\"%s\",\"%s\",\"%s\",\"%d\"" % (self.path, self.artist, self.album, self.title, self.grouping, self.length)
+        elif format == "jsonl":
+            ret = json.dumps(self.toDict(), ensure_ascii=False)
         return ret
 
-def get_ext(filename, tolower=False) -> str:
-    ext = ""
-    idx = filename.rfind('.')
-    if idx >= 0:
-        ext = filename[idx + 1:]
-    if tolower:
-        return ext.lower()
+class GroupIndex:
+    '''
+    Maps each group to the positions of the recordings that have it, built in one pass over
+    the recordings, so finding the recordings of a group doesn't look at any of the others.
+
+    query() takes AND, OR and NOT (any case) and parentheses, e.g.
+    "classic-rock AND NOT christmas" or "(am-gold | classic-rock) AND NOT live". | is OR and
+    AND binds tighter than OR.
+    '''
+    def __init__(self, recordings:list):
+        self.recordings = recordings
+        self.groups = dict()
+        for i, recording in enumerate(recordings):
+            for group in recording.grouping:
+                self.groups.setdefault(group, []).append(i)
+
+    def find(self, terms:list) -> list:
+        '''Returns the positions of the recordings in any of the groups, in order. No terms means all of them.'''
+        if len(terms) == 0:
+            return list(range(len(self.recordings)))
+        found = set()
+        for term in terms:
+            found.update(self.groups.get(term, []))
+        return sorted(found)
+
+    def query(self, text:str) -> list:
+        '''Returns the positions of the recordings matching the query, in order. Raises ValueError if it can't be parsed.'''
+        node = parse_query(text)
+        if node is None:
+            return self.find([])
+        return sorted(self.evaluate(node))
+
+    def evaluate(self, node) -> set:
+        kind = node[0]
+        if kind == "group":
+            return set(self.groups.get(node[1], []))
+        if kind == "or":
+            found = set()
+            for child in node[1]:
+                found |= self.evaluate(child)
+            return found
+        if kind == "and":
+            # Intersect the smallest sets first and subtract the NOT terms, rather than taking
+            # the complement of them, so the work follows the size of the groups involved
+            wanted = sorted((self.evaluate(child) for child in node[1] if child[0] != "not"), key=len)
+            unwanted = [self.evaluate(child[1]) for child in node[1] if child[0] == "not"]
+            if len(wanted) == 0:
+                found = set(range(len(self.recordings)))
+            else:
+                found = wanted[0].intersection(*wanted[1:])
+            return found.difference(*unwanted)
+        # NOT on its own, e.g. "NOT christmas"
+        return set(range(len(self.recordings))) - self.evaluate(node[1])
+
+QUERY_WORDS = ["AND", "OR", "NOT"]
+
+def tokenize_query(text:str) -> list:
+    for symbol in "()" + GROUP_SEPARATOR:
+        text = text.replace(symbol, " %s " % (symbol))
+    tokens = list()
+    for token in text.split():
+        if token.upper() in QUERY_WORDS:
+            token = token.upper()
+        elif token == GROUP_SEPARATOR:
+            token = "OR"
+        tokens.append(token)
+    return tokens
+
+def parse_query(text:str):
+    '''Returns the parsed query, or None if it's empty. Raises ValueError if it can't be parsed.'''
+    tokens = tokenize_query(text)
+    if len(tokens) == 0:
+        return None
+    node, pos = parse_or(tokens, 0)
+    if pos < len(tokens):
+        raise ValueError("Unexpected %s in query: %s" % (tokens[pos], text))
+    return node
+
+def parse_or(tokens:list, pos:int):
+    children = list()
+    node, pos = parse_and(tokens, pos)
+    children.append(node)
+    while pos < len(tokens) and tokens[pos] == "OR":
+        node, pos = parse_and(tokens, pos + 1)
+        children.append(node)
+    if len(children) == 1:
+        return children[0], pos
+    return ("or", children), pos
+
+def parse_and(tokens:list, pos:int):
+    children = list()
+    node, pos = parse_not(tokens, pos)
+    children.append(node)
+    while pos < len(tokens) and tokens[pos] == "AND":
+        node, pos = parse_not(tokens, pos + 1)
+        children.append(node)
+    if len(children) == 1 and children[0][0] != "not":
+        return children[0], pos
+    return ("and", children), pos
+
+def parse_not(tokens:list, pos:int):
+    if pos >= len(tokens):
+        raise ValueError("Query ends too soon")
+    token = tokens[pos]
+    if token == "NOT":
+        node, pos = parse_not(tokens, pos + 1)
+        return ("not", node), pos
+    if token == "(":
+        node, pos = parse_or(tokens, pos + 1)
+        if pos >= len(tokens) or tokens[pos] != ")":
+            raise ValueError("Missing ) in query")
+        return node, pos + 1
+    if token in [")", "AND", "OR"]:
+        raise ValueError("Unexpected %s in query" % (token))
+    return ("group", token), pos + 1
+
+def matches(node, groups:set) -> bool:
+    '''Returns True if a recording with groups matches the parsed query. None matches everything.'''
+    if node is None:
+        return True
+    kind = node[0]
+    if kind == "group":
+        return node[1] in groups
+    if kind == "or":
+        return any(matches(child, groups) for child in node[1])
+    if kind == "and":
+        return all(matches(child, groups) for child in node[1])
+    return not matches(node[1], groups)
+
+def read_spec(filename:str) -> list:
+    '''
+    Reads a playlist spec file for print. Each line is "term,title,output", where term is a
+    group or a query (see GroupIndex), e.g. "am-gold|classic-rock" or "classic-rock AND NOT
+    christmas", and title is the #PLAYLIST: value for m3u output. Blank lines and lines
+    starting with # are skipped.
+    '''
+    specs = list()
+    with open(filename, mode="rt", encoding="utf-8-sig", newline="") as f:
+        for line in csv.reader(f):
+            if len(line) == 0 or line[0].strip() == "" or line[0].strip()[0] == '#':
+                continue
+            if len(line) < 3:
+                raise ValueError("%s: expected term,title,output but found %s" % (filename, ",".join(line)))
+            query = line[0].strip()
+            parse_query(query)
+            specs.append((query, line[1].strip(), line[2].strip()))
+    return specs
+
+# Output files for print are written in blocks of this size rather than a line at a time
+OUTPUT_BUFFER = 1024 * 1024
+
+class RecordingWriter:
+    '''
+    Writes recordings to output_fh one at a time as they're produced, in one of the print
+    formats: txt, m3u or m3u8 (#EXTINF lines, always UTF-8), csv (csv.writer, with a header
+    row) or jsonl (one JSON object per line).
+    '''
+    def __init__(self, output_fh, format:str, playlist:str):
+        self.output_fh = output_fh
+        self.format = format
+        self.count = 0
+        self.csv = None
+        if format in ["m3u", "m3u8"]:
+            output_fh.write("#EXTM3U\n#PLAYLIST:%s\n" % (playlist))
+        elif format == "csv":
+            self.csv = csv.writer(output_fh, quoting=csv.QUOTE_ALL, lineterminator="\n")
+            self.csv.writerow(["Path", "Artist", "Album", "Title", "Grouping", "Length"])
+
+    def write(self, recording:Recording):
+        if self.csv is not None:
+            self.csv.writerow([recording.path, recording.artist, recording.album, recording.title, GROUP_SEPARATOR.join(sorted(recording.grouping)), recording.length])
+        else:
+            self.output_fh.write("%s\n" % (recording.toString(self.format)))
+        self.count += 1
+
+    def flush(self):
+        self.output_fh.flush()
+
+def write_recordings(output_fh, recordings:list, positions:list, format:str, playlist:str):
+    writer = RecordingWriter(output_fh, format, playlist)
+    for i in positions:
+        writer.write(recordings[i])
+    writer.flush()
+
+# Copies are written under this name and renamed when complete, so an interrupted copy never
+# leaves a partial file that looks up to date
+PART_SUFFIX = ".part"
+COVER_FILE = "cover.jpg"
+
+def parse_size(text:str) -> int:
+    '''Parses a size such as 500M, 32G or 1000000 (bytes). Raises ValueError if it isn't one.'''
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    text = text.strip().upper()
+    if text.endswith("B"):
+        text = text[:-1]
+    multiplier = 1
+    if len(text) > 0 and text[-1] in units:
+        multiplier = units[text[-1]]
+        text = text[:-1]
+    return int(float(text) * multiplier)
+
+def is_up_to_date(src:os.stat_result, dest:str) -> bool:
+    # FAT file systems (SD cards, many phones) only keep modification times to 2 seconds
+    try:
+        st = os.stat(dest)
+    except OSError:
+        return False
+    return st.st_size == src.st_size and abs(st.st_mtime - src.st_mtime) <= 2
+
+def copy_file(src:str, dest:str):
+    '''Copies src to dest unless dest is already up to date. Returns (src, copied, bytes, error).'''
+    try:
+        st = os.stat(src)
+        if is_up_to_date(st, dest):
+            return src, False, 0, None
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copy2(src, dest + PART_SUFFIX)
+        os.replace(dest + PART_SUFFIX, dest)
+    except OSError as e:
+        return src, False, 0, "%s: %s" % (src, e)
+    return src, True, st.st_size, None
+
+def plan_copy(recordings:list, base:str, destination:str, max_bytes:int):
+    '''
+    Returns the (source, destination) pairs to copy: each recording plus the cover.jpg of its
+    folder, keeping their paths relative to base. With max_bytes, recordings (and their cover)
+    that would take the total over it are left out. Returns (pairs, total bytes, left out).
+    '''
+    pairs = list()
+    folders = set()
+    total = 0
+    left_out = 0
+    for recording in recordings:
+        src = os.path.abspath(recording.path)
+        rel = os.path.relpath(src, base)
+        if rel.startswith(".."):
+            print(Fore.RED + "%s is not under %s" % (src, base) + Fore.BLACK, file=sys.stderr)
+            continue
+        try:
+            size = os.path.getsize(src)
+        except OSError as e:
+            print(Fore.RED + "%s: %s" % (src, e) + Fore.BLACK, file=sys.stderr)
+            continue
+
+        folder = os.path.dirname(src)
+        cover = os.path.join(folder, COVER_FILE)
+        cover_size = 0
+        if folder not in folders and os.path.isfile(cover):
+            cover_size = os.path.getsize(cover)
+        if max_bytes > 0 and total + size + cover_size > max_bytes:
+            left_out += 1
+            continue
+
+        total += size + cover_size
+        pairs.append((src, os.path.join(destination, rel)))
+        if folder not in folders:
+            folders.add(folder)
+            if cover_size > 0:
+                pairs.append((cover, os.path.join(destination, os.path.dirname(rel), COVER_FILE)))
+    return pairs, total, left_out
+
+def copy_recordings(recordings:list, base:str, destination:str, max_bytes:int, jobs:int, verbose:bool):
+    '''Copies the recordings (and covers) to destination on a thread pool, skipping the ones already there.'''
+    pairs, total, left_out = plan_copy(recordings, base, destination, max_bytes)
+    copied = 0
+    copied_bytes = 0
+    skipped = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for src, done, size, error in pool.map(lambda pair: copy_file(pair[0], pair[1]), pairs):
+            if error is not None:
+                print(Fore.RED + error + Fore.BLACK, file=sys.stderr)
+                failed += 1
+            elif done:
+                copied += 1
+                copied_bytes += size
+                if verbose:
+                    print(Fore.GREEN + "%s" % (src) + Fore.BLACK, file=sys.stderr)
+            else:
+                skipped += 1
+    print("Copied %d files (%s), %d already up to date, %d failed" % (copied, format_bytes(copied_bytes), skipped, failed), file=sys.stderr)
+    print("Size at destination: %s" % (format_bytes(total)), file=sys.stderr)
+    if left_out > 0:
+        print(Fore.YELLOW + "%d recordings did not fit in %s" % (left_out, format_bytes(max_bytes)) + Fore.BLACK, file=sys.stderr)
+
+class LibraryStats:
+    '''
+    Totals of a library, gathered in one pass with add(). Each section maps a key to
+    [recordings, seconds, bytes]: "library" has the single key "all", "group", "genre" and
+    "decade" have one key per value, "rating" is keyed by stars (0 is unrated) and "pair"
+    counts the recordings in both of two groups, keyed "a + b".
+    '''
+    SECTIONS = ["library", "group", "rating", "genre", "decade", "pair"]
+
+    def __init__(self):
+        self.sections = {name: dict() for name in LibraryStats.SECTIONS}
+
+    def count(self, section:str, key:str, length:int, size:int):
+        totals = self.sections[section].get(key)
+        if totals is None:
+            totals = self.sections[section][key] = [0, 0, 0]
+        totals[0] += 1
+        totals[1] += length
+        totals[2] += size
+
+    def add(self, recording):
+        length = max(recording.length, 0)
+        size = recording.filesize
+        self.count("library", "all", length, size)
+        # Ratings are POPM values, 51 to a star
+        self.count("rating", str(min((recording.rating + 25) // 51, 5)), length, size)
+        for genre in recording.genre:
+            self.count("genre", genre, length, size)
+        decade = "unknown"
+        if recording.year > 0:
+            decade = "%ds" % (recording.year - recording.year % 10)
+        self.count("decade", decade, length, size)
+        groups = sorted(recording.grouping)
+        for i, group in enumerate(groups):
+            self.count("group", group, length, size)
+            for other in groups[i + 1:]:
+                self.count("pair", "%s + %s" % (group, other), length, size)
+
+    def rows(self):
+        '''Yields [section, key, recordings, seconds, bytes], each section sorted by key.'''
+        for section in LibraryStats.SECTIONS:
+            for key in sorted(self.sections[section]):
+                yield [section, key] + self.sections[section][key]
+
+def write_stats(output_fh, stats:LibraryStats, format:str):
+    if format == "json":
+        ret = dict()
+        for section, key, count, length, size in stats.rows():
+            ret.setdefault(section, dict())[key] = {"recordings": count, "seconds": length, "bytes": size}
+        json.dump(ret, output_fh, indent=2, ensure_ascii=False)
+        output_fh.write("\n")
     else:
-        return ext
+        writer = csv.writer(output_fh, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        writer.writerow(["Section", "Key", "Recordings", "Length", "File Size"])
+        writer.writerows(stats.rows())
 
 class Action(Enum):
     ADD = 1
@@ -213,22 +556,60 @@ class Action(Enum):
     STATS = 4
     COPY = 5
 
+def change_groups(mediafile:str, action, terms:list, writer:TagWriter):
+    '''
+    Adds or deletes the terms in the groups of mediafile and saves it, but only if that
+    changes the groups. Returns (mediafile, recording, saved, error). Only the tag block is read to
+    check, so files that are already up to date are never opened for writing.
+    '''
+    try:
+        tags = load_id3(mediafile)
+        if tags is None:
+            return mediafile, None, False, "Could not open: %s" % (mediafile)
+        recording = Recording()
+        recording.fromID3(mediafile, tags)
+    except Exception as e:
+        return mediafile, None, False, "Could not open: %s" % (mediafile)
+
+    if action == Action.DELETE:
+        recording.deleteGroups(terms)
+    elif action == Action.ADD:
+        recording.addGroups(terms)
+    if not recording.modified:
+        return mediafile, recording, False, None
+
+    try:
+        tags = mutagen.id3.ID3(mediafile) # type: ignore
+        tags.setall('GRP1', [mutagen.id3.GRP1(text=recording.getGroupingAsString())]) # type: ignore
+        writer.save(tags)
+    except Exception as e:
+        return mediafile, None, False, "Could not save %s: %s" % (mediafile, e)
+    recording.modified = False
+    return mediafile, recording, True, None
+
 def main():
     parser = argparse.ArgumentParser(description='Do actions on MP3 file group tags')
-    parser.add_argument('action', help='add, delete, print stats')
-    parser.add_argument('-i','input', help='Folder of media files or a text file containing a list of files')
-    parser.add_argument('-l','--list', help='List of all files')
+    parser.add_argument('input', help='Folder of media files or a text file containing a list of files')
+    parser.add_argument('action', help='add, delete, print, stats, copy')
+    parser.add_argument('-l','--list', help='List of all files from generate-metadata-list (CSV or --index file)')
     parser.add_argument('-d','--destination', help='Destination directory for copy')
-    parser.add_argument("-f", "--format", help="Format of output (depends on action)")
+    parser.add_argument("-f", "--format", help="Format of output: txt, csv, m3u, m3u8 or jsonl for print, csv or json for stats, bat, ps1 or sh for a copy script")
     parser.add_argument("-t", "--term", action="append", help="Terms to add, delete, or print")
+    parser.add_argument("-q", "--query", help="For print and copy, groups to match with AND, OR, NOT, e.g. \"classic-rock AND NOT christmas\"")
     parser.add_argument("-o", "--output", help="Output file for print or stat actions")
     parser.add_argument("-p", "--playlist", help="Output playlist title (inside m3u file)")
+    parser.add_argument("-s", "--spec", help="For print, a file of term,title,output lines to write several playlists from one load")
+    parser.add_argument("-e", "--exclude", action="append", help="File or folder name pattern to skip when scanning (e.g. Playlists)")
+    parser.add_argument("-j", "--jobs", help="Number of files saved by add and delete, or copied by copy, at once (default: 4)", default=4, type=int)
+    parser.add_argument("--max-bytes", help="For copy, stop adding recordings at this total size, e.g. 32G")
+    parser.add_argument("-c", "--cache", help="Tag cache file for print and stats (default: %s)" % (DEFAULT_CACHE), default=DEFAULT_CACHE)
+    parser.add_argument("--no-cache", help="Read every file, don't use the tag cache", action="store_true", default=False)
     parser.add_argument("-v", "--verbose", help="Verbose output (default: False)", action="store_true", default=False)
 
     args = parser.parse_args()
     
     if (args is None):
-        print(Fore.RED + "Could not parse command line. Terminating." + Fore.BLACK)
+        print(Fore.RED + "Could not parse command line. Terminating." + Fore.BLACK, file=sys.stderr)
         return
 
     actions = {
@@ -241,196 +622,274 @@ def main():
     try:
         action = actions[args.action]
     except:
-        print(Fore.RED + "Invalid action: %s" % args.action + Fore.BLACK)
+        print(Fore.RED + "Invalid action: %s" % args.action + Fore.BLACK, file=sys.stderr)
         return
 
     if args.input is None and args.list is None:
-        print(Fore.RED + "Must provide either --input or --list argument" % args.action + Fore.BLACK)
+        print(Fore.RED + "Must provide either --input or --list argument" % args.action + Fore.BLACK, file=sys.stderr)
         return
 
-    output_fh = None
-    if args.output is None:
-        if args.verbose and action in [Action.PRINT]:
-            print(Fore.YELLOW + "No output file specified, so sending to stdout. This can be messy when --verbose is used." + Fore.BLACK)
-        output_fh = sys.stdout
-    else:
-        try:
-            output_fh = open(args.output, mode="wt", encoding="utf-8")
-        except Exception as e:
-            print(Fore.RED + "%s: %s" % (args.output, e) + Fore.BLACK)
-            return
-    
     destination = args.destination
     if destination is None:
         if action in [Action.COPY]:
-            print(Fore.RED + "Destination required for copy action" + Fore.BLACK)
+            print(Fore.RED + "Destination required for copy action" + Fore.BLACK, file=sys.stderr)
             return
 
     playlist = datetime.datetime.now().strftime("%B %d, %Y %I:%M%p")
     script_formats = ["bat","ps1","sh"]
-    text_formats = ["txt","csv","m3u"]
+    text_formats = ["txt","csv","m3u","m3u8","jsonl"]
+    stats_formats = ["csv","json"]
     formats = text_formats + script_formats
 
+    # Without a format, copy copies the files itself rather than writing a script
+    copy_formats = ["native"] + script_formats
     format = args.format
     if format is None:
-        format = "txt"
+        if action in [Action.COPY]:
+            format = "native"
+        elif action in [Action.STATS]:
+            format = "csv"
+        else:
+            format = "txt"
 
     if action in [Action.PRINT]:
         if format not in text_formats:
-            print(Fore.RED + "Invalid format for print action: %s" % format + Fore.BLACK)
+            print(Fore.RED + "Invalid format for print action: %s" % format + Fore.BLACK, file=sys.stderr)
+            return
+
+    if action in [Action.STATS]:
+        if format not in stats_formats:
+            print(Fore.RED + "Invalid format for stats action: %s" % format + Fore.BLACK, file=sys.stderr)
             return
 
     if action in [Action.COPY]:
-        if format not in script_formats:
-            print(Fore.RED + "Invalid format for copy action: %s" % format + Fore.BLACK)
+        if format not in copy_formats:
+            print(Fore.RED + "Invalid format for copy action: %s" % format + Fore.BLACK, file=sys.stderr)
+            return
+
+    max_bytes = 0
+    if args.max_bytes is not None:
+        try:
+            max_bytes = parse_size(args.max_bytes)
+        except ValueError:
+            print(Fore.RED + "Invalid size: %s" % args.max_bytes + Fore.BLACK, file=sys.stderr)
+            return
+
+    # Native copy writes no output and only it can leave files out, so -o and --max-bytes are
+    # checked before the output file is created
+    native_copy = action in [Action.COPY] and format == "native"
+    if args.max_bytes is not None and not native_copy:
+        print(Fore.RED + "The --max-bytes option is only valid for copy without --format" + Fore.BLACK, file=sys.stderr)
+        return
+    if args.output is not None and native_copy:
+        print(Fore.RED + "The --output option is only valid for copy with a script --format" + Fore.BLACK, file=sys.stderr)
+        return
+
+    # Status and error messages go to stderr, so output sent to stdout can be piped into another tool
+    output_fh = None
+    if args.output is None:
+        if args.verbose and action in [Action.PRINT] and args.spec is None:
+            print(Fore.YELLOW + "No output file specified, so sending to stdout." + Fore.BLACK, file=sys.stderr)
+        output_fh = sys.stdout
+    else:
+        try:
+            output_fh = open(args.output, mode="wt", encoding="utf-8", buffering=OUTPUT_BUFFER)
+        except Exception as e:
+            print(Fore.RED + "%s: %s" % (args.output, e) + Fore.BLACK, file=sys.stderr)
+            return
+    
+    specs = list()
+    if args.spec is not None:
+        if action not in [Action.PRINT]:
+            print(Fore.RED + "The --spec option is only valid for print" + Fore.BLACK, file=sys.stderr)
+            return
+        try:
+            specs = read_spec(args.spec)
+        except (OSError, ValueError) as e:
+            print(Fore.RED + "%s" % (e) + Fore.BLACK, file=sys.stderr)
+            return
+
+    if args.query is not None:
+        if action not in [Action.PRINT, Action.COPY]:
+            print(Fore.RED + "The --query option is only valid for print and copy" + Fore.BLACK, file=sys.stderr)
+            return
+        try:
+            parse_query(args.query)
+        except ValueError as e:
+            print(Fore.RED + "%s" % (e) + Fore.BLACK, file=sys.stderr)
             return
 
     terms = list()
     if args.term is not None:
         for term in args.term:
             terms.append(str(term.replace(GROUP_SEPARATOR, "")))
-    else:
+    elif args.query is None:
         if action not in [Action.STATS, Action.PRINT]:
-            print(Fore.RED + "Term(s) are required for this action" + Fore.BLACK)
+            print(Fore.RED + "Term(s) are required for this action" + Fore.BLACK, file=sys.stderr)
             return
 
     media_extensions = ["mp3","m4a","m4b"]
 
+    if args.playlist is not None:
+        playlist = args.playlist
+
+    # print without a spec writes each matching recording as soon as it's loaded, so output
+    # starts straight away and the library isn't held in memory
+    stream = None
+    wanted = None
+    if action == Action.PRINT and len(specs) == 0:
+        stream = RecordingWriter(output_fh, format, playlist)
+        if args.query is not None:
+            wanted = parse_query(args.query)
+        elif len(terms) > 0:
+            wanted = ("or", [("group", term) for term in terms])
+
     recordings = list()
+
+    def keep(recording:Recording):
+        if stream is None:
+            recordings.append(recording)
+        elif matches(wanted, recording.grouping):
+            stream.write(recording)
     if args.list is not None:
         if action in [Action.STATS, Action.PRINT, Action.COPY]:
-            with open(args.list,'rt',encoding="utf-8") as f:  
-                reader = csv.reader(f) 
-                for line in reader:
-                    recording = Recording()
-                    recording.fromList(line)
-                    recordings.append(recording)
+            # Either the CSV list or the binary index from generate-metadata-list
+            for line in load_library(args.list).rows():
+                recording = Recording()
+                recording.fromList(line)
+                keep(recording)
         else:
-            print(Fore.RED + "The --list option is only valid for this action" + Fore.BLACK)
+            print(Fore.RED + "The --list option is only valid for this action" + Fore.BLACK, file=sys.stderr)
             return
 
+    # A folder is scanned as a stream, so files are processed while the walk continues.
+    # Otherwise the input is a text file (e.g. an m3u) listing the files to work on.
     mediafiles = list()
     if args.verbose:
-        print(Fore.GREEN + "Start Directory: %s" % (args.input) + Fore.BLACK)
+        print(Fore.GREEN + "Start Directory: %s" % (args.input) + Fore.BLACK, file=sys.stderr)
     if os.path.isdir(args.input):
-        for root, dirs, files in os.walk(args.input):
-            for file in files:
-                filename = str(file)
-                if get_ext(filename, tolower=True) in media_extensions:
-                    mediafiles.append(os.path.join(root, file))
-        mediafiles.sort()
+        mediafiles = find_media(args.input, media_extensions, exclude=args.exclude)
+        if args.list is None:
+            # Only waits for the first file, the rest of the folder is still scanned as a stream
+            first = next(mediafiles, None)
+            if first is None:
+                print(Fore.RED + "No files to process" + Fore.BLACK, file=sys.stderr)
+                return
+            mediafiles = itertools.chain([first], mediafiles)
     else:
         with open(args.input, mode="rt", encoding='utf-8-sig') as file:
-            mediafiles = [line.strip() for line in file if line.strip()]
-        mediafiles.sort()
-        for mediafile in reversed(mediafiles):
-            if mediafile[0] == '#':
-                mediafiles.remove(mediafile)
+            mediafiles = [line.strip() for line in file if line.strip() and line.strip()[0] != '#']
+        # A file listed twice would be changed by two threads at once, so each is kept once
+        mediafiles = sorted(dict.fromkeys(mediafiles))
     
         if len(mediafiles) == 0:
-            print(Fore.RED + "No files to process" + Fore.BLACK)
+            print(Fore.RED + "No files to process" + Fore.BLACK, file=sys.stderr)
             return
 
-    if args.verbose:
-        print(Fore.GREEN + "Files to process: %d" % (len(mediafiles)) + Fore.BLACK)
+        if args.verbose:
+            print(Fore.GREEN + "Files to process: %d" % (len(mediafiles)) + Fore.BLACK, file=sys.stderr)
 
-    if format == "m3u":
-        if args.playlist is not None:
-            playlist = args.playlist
-        output_fh.write("#EXTM3U\n#PLAYLIST:%s\n" % (playlist))
- 
     copy_folders = set()
     total_bytes = 0
     total_files = 0
 
     if action in [Action.ADD, Action.DELETE]:
-        for mediafile in mediafiles:
-            head,tail = os.path.split(Path(mediafile))
-            if args.verbose:
-                print(Fore.GREEN + "%s" % (mediafile) + Fore.BLACK)
-            try:
-                mp3file = MP3(mediafile)
-            except Exception as e:
-                print(Fore.RED + "Could not open: %s" % mediafile + Fore.BLACK)
-            else:
-                recording = Recording()
-                recording.fromMP3(mp3file)
+        # Files are checked (and saved if needed) on a thread pool. pool.map() hands back the
+        # results in the order of the files.
+        saved = 0
+        skipped = 0
+        failed = 0
+        writer = TagWriter()
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            for mediafile, recording, changed, error in pool.map(lambda mediafile: change_groups(mediafile, action, terms, writer), mediafiles):
+                if error is not None:
+                    print(Fore.RED + error + Fore.BLACK, file=sys.stderr)
+                    failed += 1
+                    continue
                 recordings.append(recording)
-                
-                if action == Action.DELETE:
-                    tags = getattr(mp3file, "tags")
-                    if tags is not None:
-                        recording.deleteGroups(terms)
-                        tags.setall('GRP1', [mutagen.id3.GRP1(text=recording.getGroupingAsString())]) # type: ignore
-                        try:
-                            mp3file.save()
-                        except Exception as e:
-                            print("Could not save %s: %s" % (mediafile, e))
-                            
-                elif action == Action.ADD:
-                    tags = getattr(mp3file, "tags")
-                    if tags is not None:
-                        recording.addGroups(terms)
-                        tags.setall('GRP1', [mutagen.id3.GRP1(text=recording.getGroupingAsString())]) # type: ignore
-                        try:
-                            mp3file.save()
-                        except Exception as e:
-                            print("Could not save %s: %s" % (mediafile, e))
+                if changed:
+                    saved += 1
+                    if args.verbose:
+                        print(Fore.GREEN + "%s" % (mediafile) + Fore.BLACK, file=sys.stderr)
+                else:
+                    skipped += 1
+        print("Saved %d files, %d already up to date, %d failed. %s" % (saved, skipped, failed, writer.summary()), file=sys.stderr)
     else:
-        if len(recordings) == 0:
+        if len(recordings) == 0 and args.list is None:
+            # Read-only actions can use the tag cache, so unchanged files only cost a stat()
+            cache = None
+            if not args.no_cache:
+                cache = open_cache(args.cache)
             for mediafile in mediafiles:
                 head,tail = os.path.split(Path(mediafile))
                 if args.verbose:
-                    print(Fore.GREEN + "%s" % (mediafile) + Fore.BLACK)
+                    print(Fore.GREEN + "%s" % (mediafile) + Fore.BLACK, file=sys.stderr)
                 try:
-                    mp3file = MP3(mediafile)
+                    tags = load_tags(mediafile, cache)
                 except Exception as e:
-                    print(Fore.RED + "Could not open: %s" % mediafile + Fore.BLACK)
+                    print(Fore.RED + "Could not open: %s" % mediafile + Fore.BLACK, file=sys.stderr)
                 else:
                     recording = Recording()
-                    recording.fromMP3(mp3file)
-                    recordings.append(recording)
-
-        for recording in recordings:   
-            if action == Action.PRINT:
-                do_action = False
-                if len(terms) == 0:
-                    do_action = True
-                else:
-                    for item in recording.grouping:
-                        if item in terms:
-                            do_action = True
-                            break
-
-                if do_action:
-                    print_string = recording.toString(format)
-                    output_fh.write("%s\n" % (print_string))
-
-            elif action == Action.COPY:
-                do_action = False
-                if len(terms) == 0:
-                    do_action = True
-                else:
-                    for item in recording.grouping:
-                        if item in terms:
-                            do_action = True
-                            break
-
-                if do_action:
-                    head,tail = os.path.split(Path(recording.path))
-                    total_bytes += recording.filesize
-                    total_files += 1
-                    copy_folders.add(head)
+                    recording.fromTags(tags)
+                    keep(recording)
+            if cache is not None:
+                cache.close()
+
+        # The recordings to work on come from the group index, so the work follows the
+        # number of matches rather than the size of the library. When print streams, the
+        # recordings were written as they were loaded and there's nothing to index.
+        index = None
+        positions = list()
+        if stream is None:
+            index = GroupIndex(recordings)
+            if args.query is not None:
+                positions = index.query(args.query)
+            else:
+                positions = index.find(terms)
 
-            elif action == Action.STATS:
-                pass
+        if action == Action.PRINT and stream is not None:
+            stream.flush()
+            if args.verbose:
+                print(Fore.GREEN + "Recordings written: %d" % (stream.count) + Fore.BLACK, file=sys.stderr)
 
-    if action == Action.COPY:
+        elif action == Action.PRINT:
+            # Every playlist in the spec comes from the one load of the recordings
+            for query, title, output in specs:
+                positions = index.query(query)
+                if args.verbose:
+                    print(Fore.GREEN + "%s: %d recordings" % (output, len(positions)) + Fore.BLACK, file=sys.stderr)
+                try:
+                    with open(output, mode="wt", encoding="utf-8") as fh:
+                        write_recordings(fh, recordings, positions, format, title)
+                except OSError as e:
+                    print(Fore.RED + "%s: %s" % (output, e) + Fore.BLACK, file=sys.stderr)
+
+        elif action == Action.COPY and format == "native":
+            base = args.input
+            if not os.path.isdir(base):
+                base = os.path.commonpath([os.path.dirname(os.path.abspath(recordings[i].path)) for i in positions]) if len(positions) > 0 else "."
+            copy_recordings([recordings[i] for i in positions], os.path.abspath(base), destination, max_bytes, args.jobs, args.verbose)
+
+        elif action == Action.COPY:
+            for i in positions:
+                recording = recordings[i]
+                head,tail = os.path.split(Path(recording.path))
+                total_bytes += recording.filesize
+                total_files += 1
+                copy_folders.add(head)
+
+        elif action == Action.STATS:
+            stats = LibraryStats()
+            for recording in recordings:
+                stats.add(recording)
+            write_stats(output_fh, stats, format)
+
+    if action == Action.COPY and format in script_formats:
         dest_folder_path = Path(destination)
         dest_folder = str(dest_folder_path.absolute())
         base_folder_path = Path(args.input)
         base_folder = str(base_folder_path.absolute())
-        for folder in copy_folders:
+        for folder in sorted(copy_folders):
             src_folder_path = Path(folder)
             src_folder = str(src_folder_path.absolute())
             partial_src_folder = src_folder.replace(base_folder, "")
@@ -443,12 +902,17 @@ def main():
                 print_string = "ROBOCOPY \"%s\" \"%s\" /E" % (src_folder, full_dest_path)
                 output_fh.write("%s\n" % (print_string))
             elif format in ["sh"]:
-                print_string = "mkdir -p \"%s\" && cp \"%s\" \"%s\" /E" % (src_folder, full_src_path, full_dest_path)
+                print_string = "mkdir -p \"%s\" && cp \"%s\"/* \"%s\"" % (full_dest_path, src_folder, full_dest_path)
                 output_fh.write("%s\n" % (print_string))
                 
-        print("Files to Copy: %d" % (total_files))
-        print("Size of media files to copy: %s" % (format_bytes(total_bytes)))
+        print("Files to Copy: %d" % (total_files), file=sys.stderr)
+        print("Size of media files to copy: %s" % (format_bytes(total_bytes)), file=sys.stderr)
 
 if __name__ == '__main__':
-    main()
-    print(Fore.WHITE + " ")
\ No newline at end of file
+    try:
+        main()
+        print(Fore.WHITE + " ", file=sys.stderr)
+    except BrokenPipeError:
+        # Whatever print was piped into (e.g. head) stopped reading. Point stdout at devnull
+        # so the flush at exit doesn't fail too.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
\ No newline at end of file
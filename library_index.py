@@ -0,0 +1,208 @@
+'''
+library_index - Columnar binary form of the list written by generate-metadata-list
+
+The CSV list (ratings-list.txt) is re-parsed row by row by every script that reads it. With
+--index, generate-metadata-list also writes the same rows as columns: the integer columns
+(rating, year, length, file size) as raw arrays, artist/album/genre/grouping dictionary
+encoded (an array of codes plus the distinct values) and path/title as one block of UTF-8
+with an array of offsets. Loading memory-maps the file and only decodes the small header,
+so a large library opens in milliseconds and values are decoded as they're used.
+
+File layout, all integers little-endian:
+    MAGIC (8 bytes) | header size (4 bytes) | JSON header | column data, 8 byte aligned
+
+load_library() accepts either format, so scripts that take a list take both.
+'''
+
+import io
+import csv
+import sys
+import json
+import mmap
+import struct
+from array import array
+
+MAGIC = b"MEDIALIB"
+INDEX_VERSION = 1
+
+# Same order as the columns of the CSV list
+COLUMNS = ["path", "artist", "album", "title", "genre", "rating", "year", "length", "grouping", "filesize"]
+INT_COLUMNS = ["rating", "year", "length", "filesize"]
+DICT_COLUMNS = ["artist", "album", "genre", "grouping"]
+TEXT_COLUMNS = ["path", "title"]
+
+class DictColumn:
+    '''A column stored as an integer code per row and the list of distinct values.'''
+    def __init__(self, codes, values:list):
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i:int) -> str:
+        return self.values[self.codes[i]]
+
+class TextColumn:
+    '''A column of strings stored end to end as UTF-8, with the offset of each one.'''
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i:int) -> str:
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+class Library:
+    '''
+    The rows of the list, held as columns. columns maps each name in COLUMNS to an indexable
+    sequence: ints for INT_COLUMNS, DictColumn for DICT_COLUMNS and strings for the rest.
+    '''
+    def __init__(self, count:int, columns:dict, source=None):
+        self.count = count
+        self.columns = columns
+        # Keeps the memory map alive as long as the columns point into it
+        self.source = source
+
+    def __len__(self):
+        return self.count
+
+    def row(self, i:int) -> list:
+        '''Returns row i as strings, in the same order as a row of the CSV list.'''
+        return [str(self.columns[name][i]) for name in COLUMNS]
+
+    def rows(self):
+        for i in range(self.count):
+            yield self.row(i)
+
+    def rows_in(self, name:str, wanted) -> set:
+        '''
+        Returns the row numbers where column name has one of the wanted values. For a dictionary
+        encoded column the values are looked up once and the rows are matched by code.
+        '''
+        column = self.columns[name]
+        wanted = set(wanted)
+        if isinstance(column, DictColumn):
+            codes = set(code for code, value in enumerate(column.values) if value in wanted)
+            return set(i for i, code in enumerate(column.codes) if code in codes)
+        return set(i for i in range(self.count) if column[i] in wanted)
+
+    def rows_where(self, name:str, predicate) -> set:
+        '''Returns the row numbers where predicate(value) is true for column name.'''
+        column = self.columns[name]
+        return set(i for i in range(self.count) if predicate(column[i]))
+
+def int_from_string(text:str) -> int:
+    try:
+        return int(text)
+    except ValueError:
+        return 0
+
+def from_rows(rows) -> Library:
+    '''Builds a Library from rows in the CSV column order. The header row is skipped.'''
+    ints = {name: array("q") for name in INT_COLUMNS}
+    codes = {name: array("i") for name in DICT_COLUMNS}
+    values = {name: dict() for name in DICT_COLUMNS}
+    texts = {name: list() for name in TEXT_COLUMNS}
+    count = 0
+    for line in rows:
+        if len(line) < len(COLUMNS) or (count == 0 and line[0] == "Path"):
+            continue
+        for name in TEXT_COLUMNS:
+            texts[name].append(line[COLUMNS.index(name)])
+        for name in INT_COLUMNS:
+            ints[name].append(int_from_string(line[COLUMNS.index(name)]))
+        for name in DICT_COLUMNS:
+            value = line[COLUMNS.index(name)]
+            codes[name].append(values[name].setdefault(value, len(values[name])))
+        count += 1
+
+    columns = dict()
+    columns.update(ints)
+    columns.update(texts)
+    for name in DICT_COLUMNS:
+        columns[name] = DictColumn(codes[name], list(values[name].keys()))
+    return Library(count, columns)
+
+def little_endian(data:array) -> bytes:
+    if sys.byteorder != "little":
+        data = array(data.typecode, data)
+        data.byteswap()
+    return data.tobytes()
+
+def write_index(filename:str, library:Library):
+    '''Writes library in the binary format.'''
+    blobs = list()
+    header = {"version": INDEX_VERSION, "count": library.count, "columns": dict()}
+
+    def add_blob(data:bytes) -> list:
+        offset = sum(len(blob) for blob in blobs)
+        blobs.append(data + b"\0" * (-len(data) % 8))
+        return [offset, len(data)]
+
+    for name in INT_COLUMNS:
+        header["columns"][name] = {"values": add_blob(little_endian(array("q", library.columns[name])))}
+    for name in DICT_COLUMNS:
+        column = library.columns[name]
+        header["columns"][name] = {"codes": add_blob(little_endian(array("i", column.codes))), "dictionary": column.values}
+    for name in TEXT_COLUMNS:
+        data = io.BytesIO()
+        offsets = array("q", [0])
+        for value in library.columns[name]:
+            data.write(value.encode("utf-8"))
+            offsets.append(data.tell())
+        header["columns"][name] = {"offsets": add_blob(little_endian(offsets)), "data": add_blob(data.getvalue())}
+
+    encoded = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    encoded += b" " * (-(len(MAGIC) + 4 + len(encoded)) % 8)
+    with open(filename, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(encoded)))
+        f.write(encoded)
+        for blob in blobs:
+            f.write(blob)
+
+def load_index(filename:str) -> Library:
+    with open(filename, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[0:len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not a library index" % (filename))
+    size = struct.unpack("<I", mapped[len(MAGIC):len(MAGIC) + 4])[0]
+    start = len(MAGIC) + 4 + size
+    header = json.loads(bytes(mapped[len(MAGIC) + 4:start]).decode("utf-8"))
+    if header.get("version") != INDEX_VERSION:
+        raise ValueError("%s was written by a different version, run generate-metadata-list again" % (filename))
+
+    view = memoryview(mapped)
+
+    def get_blob(location:list, typecode:str=""):
+        blob = view[start + location[0]:start + location[0] + location[1]]
+        if typecode == "":
+            return blob
+        if sys.byteorder != "little":
+            values = array(typecode, blob.tobytes())
+            values.byteswap()
+            return values
+        return blob.cast(typecode)
+
+    columns = dict()
+    for name in INT_COLUMNS:
+        columns[name] = get_blob(header["columns"][name]["values"], "q")
+    for name in DICT_COLUMNS:
+        columns[name] = DictColumn(get_blob(header["columns"][name]["codes"], "i"), header["columns"][name]["dictionary"])
+    for name in TEXT_COLUMNS:
+        columns[name] = TextColumn(get_blob(header["columns"][name]["offsets"], "q"), get_blob(header["columns"][name]["data"]))
+    return Library(header["count"], columns, mapped)
+
+def is_index(filename:str) -> bool:
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def load_library(filename:str) -> Library:
+    '''Loads the list written by generate-metadata-list, either the CSV or the binary index.'''
+    if is_index(filename):
+        return load_index(filename)
+    with open(filename, "rt", encoding="utf-8") as f:
+        return from_rows(csv.reader(f))
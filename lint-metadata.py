@@ -9,21 +9,11 @@ from pathlib import Path
 from unidecode import unidecode
 import mutagen
 from mutagen.mp3 import MP3
-from mutagen.easyid3 import EasyID3
 from colorama import Fore
 import requests
+from media_scanner import scan_folders
+from tag_cache import DEFAULT_CACHE, open_cache, load_tags
 
-# get_ext - check that the file extension is supported
-def get_ext(filename, tolower=False) -> str:
-    ext = ""
-    idx = filename.rfind('.')
-    if idx >= 0:
-        ext = filename[idx + 1:]
-    if tolower:
-        return ext.lower()
-    else:
-        return ext
-    
 def check_tracks(dir:str, values:set, discs, outfile):
     tracks = list()
     for value in values:
@@ -61,31 +51,37 @@ def check_same(dir:str, values:set, keystr:str, outfile, discs=1, optional=False
         return False
     return True
     
-def process_files(dir:str, mediafiles:list, args, outfile):
+# EasyID3 key names used in the checks, mapped to the cached TrackTags field holding them
+FIELDS = {
+    "date": "date",
+    "musicbrainz_albumid": "release_id",
+    "tracknumber": "track",
+    "artist": "artist",
+    "albumartist": "albumartist",
+    "album": "album",
+    "musicbrainz_albumartistid": "albumartist_id",
+    "musicbrainz_artistid": "artist_id",
+    "discnumber": "disc",
+    "genre": "genre"
+}
+
+def process_files(dir:str, mediafiles:list, args, outfile, cache=None):
     file_frames = dict()
     for mediafile in mediafiles:
         try:
-            ez = EasyID3(mediafile)
-            file_frames[mediafile] = ez
-            # print(ez.pprint())
+            file_frames[mediafile] = load_tags(mediafile, cache, need_length=False)
         except Exception as e: 
             print(e)
             continue
 
-    keys = ["date","musicbrainz_albumid","tracknumber","artist","albumartist","album","musicbrainz_albumartistid","musicbrainz_artistid","discnumber","genre"]
     values = dict()
-    for key in keys:
+    for key in FIELDS:
         values[key] = set()
-    for mediafile, ez in file_frames.items():
-        for key in keys:
-            if key in ez.valid_keys:
-                try:
-                    alist = ez[key]
-                    if alist is not None:
-                        if len(alist) > 0:
-                            values[key].add(alist[0])
-                except Exception as e:
-                    pass
+    for mediafile, tags in file_frames.items():
+        for key, name in FIELDS.items():
+            value = getattr(tags, name)
+            if len(value) > 0:
+                values[key].add(value)
 
     discs = len(values["discnumber"])
     check_same(dir, values["artist"], "artist", outfile)
@@ -114,8 +110,9 @@ def main():
     parser.add_argument('input', help='Media file or a folder of media files')
     parser.add_argument("-o", "--output", help="Output File", default="lint-metadata.log")
     parser.add_argument("-v", "--verbose", help="Be verbose (default: False)", action="store_true", default=False)
-
-    # TODO: Add option to ignore certain folder names or patterns (e.g. '.git','Playlists')
+    parser.add_argument("-e", "--exclude", action="append", help="Folder or file name pattern to ignore (e.g. .git, Playlists)")
+    parser.add_argument("-c", "--cache", help="Tag cache file (default: %s)" % (DEFAULT_CACHE), default=DEFAULT_CACHE)
+    parser.add_argument("--no-cache", help="Read every file, don't use the tag cache", action="store_true", default=False)
 
     args = parser.parse_args()
 
@@ -127,46 +124,37 @@ def main():
     # or tool that supports multiple formats
     extensions = ["mp3","m4a","m4b"] # TODO: Add flac, etc.
 
-    # Search input directory for files with the matching extension or if a single file,
-    # Make sure it's the supported extension(s)
-    mediadirs = list()
-    if len(next(os.walk(args.input))[1]) == 0:
-        mediadirs.append(args.input)
-    else:
-        for root, dirs, files in os.walk(args.input):
-            for dir in dirs:
-                mediadirs.append(os.path.join(root, dir))
-
-    # For convenience sake, sort the list of found media files by path, in case os.walk() didn't
-    mediadirs.sort()
-    if len(mediadirs) == 0:
-        print("No files to process")
-        return
-
+    # Search input directory for folders and the media files in each. The scanner reads
+    # several folders at once and hands each one over as soon as it has been listed.
+    # The top folder is only checked when it has no sub-folders (i.e. it is an album).
     outfile = open(args.output, "wt", encoding="utf-8")
+    cache = None
+    if not args.no_cache:
+        cache = open_cache(args.cache)
 
-    total = len(mediadirs)
     i = 0
+    found = 0
+    for mediadir, dirs, mediafiles in scan_folders(args.input, extensions, exclude=args.exclude):
+        found += len(mediafiles)
+        if mediadir == args.input and len(dirs) > 0:
+            continue
 
-    for mediadir in mediadirs:
         if args.verbose:
             i += 1
-            print(Fore.GREEN + "%d/%d: %s" % (i, total, mediadir) + Fore.BLACK)
-
-        files = os.listdir(mediadir)
-        mediafiles = list()
-        for file in files:
-            filename = str(file)
-            if get_ext(filename, tolower=True) in extensions:
-                mediafiles.append(os.path.join(mediadir, file))
+            print(Fore.GREEN + "%d: %s" % (i, mediadir) + Fore.BLACK)
 
         if len(mediafiles) > 0:
-            process_files(mediadir, mediafiles, args, outfile)
+            process_files(mediadir, mediafiles, args, outfile, cache)
         else:
-            if len(next(os.walk(mediadir))[1]) == 0:
+            if len(dirs) == 0:
                 outfile.write("%s: Empty folder\n" % (mediadir))
 
+    if cache is not None:
+        cache.close()
     outfile.close()  
 
+    if found == 0:
+        print("No files to process")
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,111 @@
+'''
+media_scanner - Shared library scanner used by the scripts in this collection
+
+Walks a folder tree with os.scandir, scanning several directories at once on a thread
+pool. Folders are yielded in the same order as a sorted os.walk() as soon as each one has
+been read, so callers can start processing the first album while the rest of the library
+is still being walked, and get the same order on every run. On a NAS mount most of the
+walk is spent waiting on the network, so the threads overlap that latency.
+
+Patterns are shell-style (fnmatch) and are matched against the file or folder name, not
+the full path, e.g. exclude=[".git", "Playlists", "*.part"].
+'''
+
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+
+DEFAULT_WORKERS = 8
+
+# get_ext - check that the file extension is supported
+def get_ext(filename, tolower=False) -> str:
+    ext = ""
+    idx = filename.rfind('.')
+    if idx >= 0:
+        ext = filename[idx + 1:]
+    if tolower:
+        return ext.lower()
+    else:
+        return ext
+
+def matches_any(name:str, patterns) -> bool:
+    if patterns is None:
+        return False
+    for pattern in patterns:
+        if fnmatch(name, pattern):
+            return True
+    return False
+
+def is_wanted(name:str, extensions=None, include=None, exclude=None) -> bool:
+    if extensions is not None and get_ext(name, tolower=True) not in extensions:
+        return False
+    if include is not None and len(include) > 0 and not matches_any(name, include):
+        return False
+    if matches_any(name, exclude):
+        return False
+    return True
+
+def _scan_dir(path:str, extensions, include, exclude):
+    dirs = list()
+    files = list()
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not matches_any(entry.name, exclude):
+                            dirs.append(entry.path)
+                    elif entry.is_file():
+                        if is_wanted(entry.name, extensions, include, exclude):
+                            files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError as e:
+        print("%s: %s" % (path, e), file=sys.stderr)
+    dirs.sort()
+    files.sort()
+    return path, dirs, files
+
+def scan_folders(top:str, extensions=None, include=None, exclude=None, workers=DEFAULT_WORKERS):
+    '''
+    Concurrent replacement for os.walk(). Yields (folder, subfolders, files) for every folder
+    under top, including top itself. Files are already filtered by extension and patterns.
+    Folders come in sorted top-down order, like os.walk() with sorted names, and the lists
+    in each tuple are sorted.
+    '''
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        # All the subfolders of a folder are read at once, but each is handed back in order:
+        # the stack holds the folders still to yield, next one on top
+        stack = [pool.submit(_scan_dir, top, extensions, include, exclude)]
+        while len(stack) > 0:
+            folder, dirs, files = stack.pop().result()
+            subfolders = [pool.submit(_scan_dir, dir, extensions, include, exclude) for dir in dirs]
+            stack.extend(reversed(subfolders))
+            yield folder, dirs, files
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def scan_files(top:str, extensions=None, include=None, exclude=None, workers=DEFAULT_WORKERS):
+    '''
+    Yields the path of every matching file under top as soon as its folder has been read.
+    Files from the same folder are yielded together and in sorted order, folders in the
+    order of scan_folders().
+    '''
+    for folder, dirs, files in scan_folders(top, extensions, include, exclude, workers):
+        yield from files
+
+def find_media(input:str, extensions, include=None, exclude=None, workers=DEFAULT_WORKERS):
+    '''
+    Yields the media files found at input, which is either a folder (scanned recursively)
+    or a single media file.
+    '''
+    if os.path.isdir(input):
+        yield from scan_files(input, extensions, include, exclude, workers)
+    else:
+        filename = os.path.basename(str(input))
+        if is_wanted(filename, extensions):
+            yield input
+        else:
+            print("%s is not a supported media file type" % input, file=sys.stderr)
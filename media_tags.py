@@ -0,0 +1,222 @@
+'''
+media_tags - Reads the ID3 fields the scripts in this collection care about
+
+read_tags() opens an MP3 with mutagen and returns a TrackTags record holding the fields
+used by generate-metadata-list, group-actions, lint-metadata and search-mbz-ratings. The
+record is plain data, so it can be stored in the tag cache (see tag_cache.py) and handed
+between processes. Only the frames listed in WANTED_FRAMES are decoded and each one is
+looked up directly; benchmark-tag-reading.py measures the difference.
+
+NOTE: Pylance complains about subclasses not being exported by mutagen. Even though it flags this
+as an error, it does work. It's safe to ignore.
+'''
+
+import io
+import os
+from dataclasses import dataclass, field, asdict
+import mutagen
+import mutagen.id3
+from mutagen.mp3 import MP3, MPEGInfo
+
+@dataclass
+class TrackTags:
+    path: str = ""
+    artist: str = ""
+    albumartist: str = ""
+    album: str = ""
+    title: str = ""
+    genres: list = field(default_factory=list)
+    grouping: list = field(default_factory=list)
+    rating: int = 0
+    has_rating: bool = False
+    year: int = 0
+    date: str = ""
+    track: str = ""
+    disc: str = ""
+    length: int = 0
+    filesize: int = 0
+    release_id: str = ""
+    release_track_id: str = ""
+    artist_id: str = ""
+    albumartist_id: str = ""
+
+    @property
+    def genre(self) -> str:
+        if len(self.genres) > 0:
+            return self.genres[0]
+        return ""
+
+    def toDict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def fromDict(cls, values:dict):
+        return cls(**values)
+
+# TrackTags.length when only the tag was read and the audio stream wasn't looked at
+LENGTH_UNKNOWN = -1
+
+# The first read of a file. Big enough to hold a typical tag without cover art in one
+# request, which matters on network mounts where every read is a round trip.
+ID3_PREFETCH = 64 * 1024
+
+# Text frames kept as the first value of the frame, by TXXX description
+TXXX_FIELDS = {
+    "MusicBrainz Album Id": "release_id",
+    "MusicBrainz Release Track Id": "release_track_id",
+    "MusicBrainz Artist Id": "artist_id",
+    "MusicBrainz Album Artist Id": "albumartist_id",
+}
+
+# Only these frames are decoded when reading. Everything else in the tag (cover art, lyrics,
+# the dozens of TXXX frames Picard writes, ...) is skipped by mutagen as an unknown frame.
+# TYER, TDAT and TIME are the ID3v2.3 frames mutagen turns into TDRC. ID3v2.2 frames are the
+# three letter subclasses of the v2.3/2.4 ones and are upgraded to them the same way.
+WANTED_FRAMES = ["TALB", "TPE1", "TPE2", "TIT2", "POPM", "GRP1", "TCON", "TXXX", "TDRC", "TRCK", "TPOS", "TYER", "TDAT", "TIME"]
+KNOWN_FRAMES = {name: cls for name, cls in mutagen.id3.Frames.items() if name in WANTED_FRAMES} # type: ignore
+KNOWN_FRAMES.update({name: cls for name, cls in mutagen.id3.Frames_2_2.items() if issubclass(cls, tuple(KNOWN_FRAMES.values()))}) # type: ignore
+
+def first_text(frame) -> str:
+    if frame is None:
+        return ""
+    text = getattr(frame, "text")
+    if text is not None and len(text) > 0:
+        return str(text[0]).strip()
+    return ""
+
+def year_from_text(text:str) -> int:
+    # MBZ puts in YYYY-MM-DD if it's available. I just want the year
+    year = "".join(filter(lambda x: x in "0123456789", text[0:4]))
+    if len(year) == 0:
+        return 0
+    return int(year)
+
+def number_from_text(text:str) -> int:
+    # Track and disc numbers are stored as "N" or "N/TOTAL"
+    idx = text.find('/')
+    if idx >= 0:
+        text = text[0:idx]
+    idx = text.find('.')
+    if idx >= 0:
+        text = text[0:idx]
+    try:
+        return int(text)
+    except ValueError:
+        return 0
+
+def tags_from_id3(tags, ret:TrackTags) -> TrackTags:
+    '''Fills ret from an ID3 tag by asking for the frames needed, rather than looping over
+    every frame in the tag.'''
+    ret.album = first_text(tags.get("TALB"))
+    ret.artist = first_text(tags.get("TPE1"))
+    ret.albumartist = first_text(tags.get("TPE2"))
+    ret.title = first_text(tags.get("TIT2"))
+    ret.track = first_text(tags.get("TRCK"))
+    ret.disc = first_text(tags.get("TPOS"))
+    ret.date = first_text(tags.get("TDRC"))
+
+    popm = tags.getall("POPM")
+    if len(popm) > 0:
+        ret.rating = int(getattr(popm[0], "rating"))
+        ret.has_rating = True
+
+    frame = tags.get("GRP1")
+    if frame is not None:
+        ret.grouping = [str(x) for x in getattr(frame, "text")]
+
+    frame = tags.get("TCON")
+    if frame is not None:
+        ret.genres = [x.strip() for x in frame.genres if len(x.strip()) > 0]
+
+    for desc, name in TXXX_FIELDS.items():
+        setattr(ret, name, first_text(tags.get("TXXX:" + desc)))
+
+    # Choosing to prioritize the text frame originalyear over TDRC if both exist. While
+    # TDRC is likely to be more accurate historically, I deliberately want each album to
+    # have the same year for each track so that Navidrome doesn't show multiple albums
+    # differentiated only by year.
+    ret.year = year_from_text(first_text(tags.get("TXXX:originalyear")))
+    if ret.year == 0:
+        ret.year = year_from_text(ret.date)
+    return ret
+
+def tags_from_mp3(mp3file:MP3) -> TrackTags:
+    ret = TrackTags(path=mp3file.filename) # type: ignore
+    ret.length = int(((mp3file.info.length * 1000) + 1000)/1000)
+    ret.filesize = os.path.getsize(ret.path)
+    tags = getattr(mp3file, "tags")
+    if tags is not None:
+        tags_from_id3(tags, ret)
+    return ret
+
+def id3_size(header:bytes) -> int:
+    '''Returns the total size of the ID3v2 tag (header, frames, padding and footer) given the
+    first 10 bytes of a file, or 0 if the file doesn't start with an ID3v2 tag.'''
+    if len(header) < 10 or header[0:3] != b"ID3":
+        return 0
+    # The size is a 28 bit "synchsafe" integer: 7 bits in each of 4 bytes
+    size = 10 +((header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f))
+    if header[5] & 0x10:
+        size += 10
+    return size
+
+def read_id3_block(mediafile:str) -> bytes:
+    '''Reads just the ID3v2 tag at the start of the file, never the audio after it. Returns
+    b"" if there is no ID3v2 tag.'''
+    with open(mediafile, "rb") as f:
+        data = f.read(ID3_PREFETCH)
+        size = id3_size(data[0:10])
+        if size == 0:
+            return b""
+        if size > len(data):
+            data += f.read(size - len(data))
+    return data[0:size]
+
+def load_id3(mediafile:str, known_frames=KNOWN_FRAMES):
+    '''
+    Loads the ID3 tag of mediafile from a bounded read of the tag block, without touching the
+    audio stream or the ID3v1 tag at the end of the file. Returns None if the file has no tag.
+    Only for reading: save changes through a tag loaded from the file itself.
+    '''
+    block = read_id3_block(mediafile)
+    if len(block) > 0:
+        return mutagen.id3.ID3(io.BytesIO(block), known_frames=known_frames, load_v1=False) # type: ignore
+    # Rare, but some files only have an ID3v1 tag
+    try:
+        return mutagen.id3.ID3(mediafile, known_frames=known_frames) # type: ignore
+    except mutagen.id3.ID3NoHeaderError: # type: ignore
+        return None
+
+def read_length(mediafile:str) -> int:
+    '''Reads the length in seconds from the MPEG stream, skipping over the tag.'''
+    with open(mediafile, "rb") as f:
+        offset = id3_size(f.read(10))
+        info = MPEGInfo(f, offset)
+    return int(((info.length * 1000) + 1000)/1000)
+
+def read_tags_only(mediafile:str) -> TrackTags:
+    '''Like read_tags(), but only reads the tag block, so length is LENGTH_UNKNOWN.'''
+    ret = TrackTags(path=mediafile, length=LENGTH_UNKNOWN)
+    ret.filesize = os.path.getsize(mediafile)
+    tags = load_id3(mediafile)
+    if tags is not None:
+        tags_from_id3(tags, ret)
+    return ret
+
+def read_tags(mediafile:str) -> TrackTags:
+    # Read-only, so it's safe to skip decoding the frames we don't use. Don't save a file
+    # opened this way; load it again without known_frames.
+    return tags_from_mp3(MP3(mediafile, known_frames=KNOWN_FRAMES))
+
+def read_many(mediafiles:list) -> list:
+    '''
+    Reads a chunk of files, typically in a worker process. Returns a (tags, error) tuple for
+    each file, in the same order, so one unreadable file doesn't lose the rest of the chunk.
+    '''
+    ret = list()
+    for mediafile in mediafiles:
+        try:
+            ret.append((read_tags(mediafile), None))
+        except Exception as e:
+            ret.append((None, "%s: %s" % (mediafile, e)))
+    return ret
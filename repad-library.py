@@ -0,0 +1,84 @@
+'''
+repad-library - Gives MP3 files generous ID3 padding, once, so later tag edits are written in place
+
+Files whose tag has less than --minimum padding are rewritten with --padding of room after the
+tag (see tag_writer.py). This copies each of those files once. After that, the GRP1 and POPM
+edits made by group-actions and search-mbz-ratings fit in the padding and only the tag is
+written. Files that already have enough padding aren't touched, so it's safe to run again.
+
+Like the other scripts that save tags, files are saved as ID3v2.4.
+
+NOTE: This rewrites your media files. Run this first on a sample and always keep a backup in
+case something goes wrong.
+'''
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import mutagen
+import mutagen.id3
+from colorama import Fore
+from media_scanner import find_media
+from file_sizes import format_bytes
+from tag_writer import TagWriter, DEFAULT_PADDING, id3_padding
+
+def repad(mediafile:str, writer:TagWriter, padding:int, minimum:int, dryrun:bool):
+    '''Returns (mediafile, padding before, rewritten, error).'''
+    try:
+        before = id3_padding(mediafile)
+        if before < 0 or before >= minimum:
+            return mediafile, before, False, None
+        if not dryrun:
+            writer.save(mutagen.id3.ID3(mediafile), padding=padding) # type: ignore
+    except Exception as e:
+        return mediafile, 0, False, "%s: %s" % (mediafile, e)
+    return mediafile, before, True, None
+
+def main():
+    parser = argparse.ArgumentParser(description='Add padding to the ID3 tags of MP3 files so tag edits are written in place')
+    parser.add_argument('input', help='Media file or a folder of media files')
+    parser.add_argument("-p", "--padding", help="Padding in KB to leave after the tag (default: %d)" % (DEFAULT_PADDING // 1024), default=DEFAULT_PADDING // 1024, type=int)
+    parser.add_argument("-m", "--minimum", help="Only rewrite files with less padding than this in KB (default: 4)", default=4, type=int)
+    parser.add_argument("-j", "--jobs", help="Number of files rewritten at once (default: 4)", default=4, type=int)
+    parser.add_argument("-e", "--exclude", action="append", help="File or folder name pattern to skip (e.g. Playlists, *.tmp)")
+    parser.add_argument("-n", "--dryrun", help="Only report the files that would be rewritten", action="store_true", default=False)
+    parser.add_argument("-v", "--verbose", help="Be verbose (default: False)", action="store_true", default=False)
+
+    args = parser.parse_args()
+
+    if (args is None):
+        print("Could not parse command line. Terminating.")
+        return
+
+    padding = args.padding * 1024
+    minimum = min(args.minimum * 1024, padding)
+    writer = TagWriter(padding)
+
+    mediafiles = find_media(args.input, ["mp3"], exclude=args.exclude)
+
+    total = 0
+    no_tag = 0
+    skipped = 0
+    failed = 0
+    repadded = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        for mediafile, before, rewritten, error in pool.map(lambda mediafile: repad(mediafile, writer, padding, minimum, args.dryrun), mediafiles):
+            total += 1
+            if error is not None:
+                print(Fore.RED + error + Fore.BLACK)
+                failed += 1
+            elif before < 0:
+                no_tag += 1
+            elif rewritten:
+                repadded += 1
+                if args.verbose or args.dryrun:
+                    print("%s: %s of padding" % (mediafile, format_bytes(before)))
+            else:
+                skipped += 1
+
+    if args.dryrun:
+        print(Fore.GREEN + "%d files, %d would be rewritten, %d have enough padding, %d have no tag" % (total, repadded, skipped, no_tag) + Fore.BLACK)
+    else:
+        print(Fore.GREEN + "%d files, %d rewritten (%s), %d have enough padding, %d have no tag, %d failed" % (total, repadded, format_bytes(writer.rewritten_bytes), skipped, no_tag, failed) + Fore.BLACK)
+
+if __name__ == '__main__':
+    main()
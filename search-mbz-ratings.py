@@ -1,6 +1,7 @@
 '''
 search-mbz-ratings - Searches a Musicbrainz database for song ratings and generates a 
 script to call eyed3 with commands to set the rating values for the songs, if found.
+With --apply the ratings are written to the POPM frames directly instead.
 
 NOTE: Pylance complains about subclasses not being exported by mutagen. Even though it flags this
 as an error, it does work. This should be a warning, but Pylance treats it as an error. It's safe
@@ -9,35 +10,317 @@ to ignore.
 '''
 
 import os
+import json
+import time
+import sqlite3
 import argparse
+import threading
+from collections import Counter
 from pathlib import Path
 from unidecode import unidecode
 import mutagen
 import mutagen.id3
 from colorama import Fore
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from media_scanner import find_media
+from media_tags import number_from_text
+from tag_cache import DEFAULT_CACHE, open_cache, load_tags
+from tag_writer import TagWriter
+
+# Be nice to the server: MusicBrainz asks for no more than one request per second. Use a
+# higher --rate (or 0 for no limit) against your own mirror.
+DEFAULT_RATE = 1.0
+
+HEADERS = {
+    "User-Agent":"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/111.0.0.0 Safari/537.36"
+}
+
+class RateLimiter:
+    '''Spaces calls to wait() at least 1/rate seconds apart, across all threads.'''
+    def __init__(self, rate:float):
+        self.interval = 0.0
+        if rate > 0:
+            self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next = 0.0
+
+    def wait(self):
+        if self.interval <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def make_session(jobs:int, retries:int) -> requests.Session:
+    # One pooled connection per worker thread. The server answers 503 when it's busy (or we're
+    # going too fast), so back off and retry those, honoring Retry-After if it is sent.
+    retry = Retry(total=retries, backoff_factor=1.0, status_forcelist=[503], allowed_methods=["GET"],
+                  respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, jobs), max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(HEADERS)
+    return session
+
+# Release data rarely changes, so responses are kept for a while before asking the server again
+DEFAULT_RELEASE_CACHE = os.path.join(os.path.expanduser("~"), ".mbz-release-cache.sqlite")
+DEFAULT_TTL_DAYS = 7.0
+RELEASE_INC = "aliases+artist-credits+labels+recordings+ratings"
+
+class ReleaseCache:
+    '''
+    On-disk cache of release JSON keyed by MBID and inc set. Entries younger than the TTL are
+    used without asking the server. Older ones are revalidated with the ETag/Last-Modified the
+    server sent, so an unchanged release costs a 304 instead of the whole document.
+    Shared by the worker threads, so every access holds the lock.
+    '''
+    def __init__(self, filename:str, ttl_days:float):
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.hits = 0
+        self.revalidated = 0
+        self.downloaded = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS releases (mbid TEXT, inc TEXT, fetched REAL, etag TEXT, modified TEXT, data TEXT, PRIMARY KEY (mbid, inc))")
+        self.db.commit()
+
+    def get(self, mbid:str, inc:str):
+        with self.lock:
+            return self.db.execute("SELECT fetched, etag, modified, data FROM releases WHERE mbid = ? AND inc = ?", (mbid, inc)).fetchone()
+
+    def is_fresh(self, entry) -> bool:
+        return entry is not None and time.time() - entry[0] < self.ttl
+
+    def put(self, mbid:str, inc:str, etag:str, modified:str, data:str):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO releases (mbid, inc, fetched, etag, modified, data) VALUES (?, ?, ?, ?, ?, ?)",
+                            (mbid, inc, time.time(), etag, modified, data))
+            self.db.commit()
+
+    def touch(self, mbid:str, inc:str):
+        with self.lock:
+            self.db.execute("UPDATE releases SET fetched = ? WHERE mbid = ? AND inc = ?", (time.time(), mbid, inc))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+def fetch_release(session:requests.Session, limiter:RateLimiter, server:str, rid:str, cache:ReleaseCache|None=None, offline:bool=False):
+    '''Returns (release JSON, None) or (None, error message).'''
+    payload = {
+        "inc":RELEASE_INC,
+        "fmt":"json"
+    }
+    url = server + "/ws/2/release/" + str(rid)
+
+    entry = None
+    headers = dict()
+    if cache is not None:
+        entry = cache.get(rid, RELEASE_INC)
+        if cache.is_fresh(entry) or (offline and entry is not None):
+            cache.hits += 1
+            return json.loads(entry[3]), None # type: ignore
+        if entry is not None:
+            if entry[1]:
+                headers["If-None-Match"] = entry[1]
+            if entry[2]:
+                headers["If-Modified-Since"] = entry[2]
+    if offline:
+        return None, "Not in the release cache (offline)"
+
+    limiter.wait()
+    try:
+        response = session.get(url, params=payload, headers=headers, timeout=60)
+        if response.status_code == 304 and entry is not None and cache is not None:
+            cache.touch(rid, RELEASE_INC)
+            cache.revalidated += 1
+            return json.loads(entry[3]), None
+        if response.status_code != 200:
+            return None, "Error %d retrieving data" % (response.status_code)
+        release = response.json()
+    except Exception as e:
+        return None, str(e)
+
+    if release is None:
+        return None, "Empty response"
+    if cache is not None:
+        cache.downloaded += 1
+        cache.put(rid, RELEASE_INC, response.headers.get("ETag", ""), response.headers.get("Last-Modified", ""), response.text)
+    return release, None
+
+# How a file was matched to a track in the release, for the summary
+MATCH_TRACK_ID = "release track id"
+MATCH_POSITION = "disc and position"
+MATCH_ANY_DISC = "position on any disc"
+
+class ReleaseFiles:
+    '''
+    The files of one release, indexed by MusicBrainz Release Track Id, and by (disc, position)
+    once the release's track ids are known (see positions()), so each track returned by the
+    server finds its files with a lookup instead of a scan. Files without a disc number are
+    filed under disc 0, which matches a track at that position when only one medium has it.
+    '''
+    def __init__(self):
+        self.recordings = []
+        self.by_id = dict()
+
+    def add(self, recording:dict):
+        self.recordings.append(recording)
+        if recording["recording_id"] != "":
+            self.by_id.setdefault(recording["recording_id"], []).append(recording)
+
+    def positions(self, track_ids:set) -> dict:
+        '''
+        Returns the files to match by (disc, position), leaving out the ones whose Release Track
+        Id is in track_ids, since those are matched by the id. Picard writes the id exact, so
+        files without one, or with an id that isn't on this release, fall back to the disc and
+        position. Built once per release rather than filtered again for every track.
+        '''
+        ret = dict()
+        for item in self.recordings:
+            if item["recording_id"] not in track_ids:
+                ret.setdefault((item["disc_no"], item["track_no"]), []).append(item)
+        return ret
+
+def index_recordings(recordings:list) -> dict:
+    '''Groups the recordings by release ID into ReleaseFiles.'''
+    index = dict()
+    for recording in recordings:
+        if recording["release_id"] not in index:
+            index[recording["release_id"]] = ReleaseFiles()
+        index[recording["release_id"]].add(recording)
+    return index
+
+def set_rating(found:list, rating) -> int:
+    '''Marks the files matched and sets their rating. Returns how many weren't matched before.'''
+    count = 0
+    for item in found:
+        if not item["matched"]:
+            count += 1
+        item["matched"] = True
+        if rating is not None:
+            item["rating"] = rating
+    return count
+
+def apply_ratings(release:dict, files:ReleaseFiles, stats:Counter):
+    # Look through the list of returned tracks, find the files for each one and set the rating
+    # if the track has one. Each track is two or three dictionary lookups. stats counts the
+    # files matched by each strategy, each file once.
+    media_list = [media for media in release["media"] if "tracks" in media]
+    track_ids = set(track["id"] for media in media_list for track in media["tracks"] if "id" in track)
+    by_id = files.by_id
+    by_position = files.positions(track_ids)
+    matched_id = 0
+    matched_position = 0
+    matched_any_disc = 0
+    discs_with_position = None
+    for media in media_list:
+        disc = int(media.get("position", 0) or 0)
+        for track in media["tracks"]:
+            position = track.get("position")
+            if position is None:
+                continue
+            position = int(position)
+            rating = None
+            recording = track.get("recording")
+            if recording is not None and recording.get("rating") is not None:
+                value = recording["rating"].get("value")
+                if value is not None:
+                    rating = int(float(value) * 51.0)
+
+            found = by_id.get(track.get("id", ""))
+            if found is not None:
+                matched_id += set_rating(found, rating)
+            if len(by_position) == 0:
+                continue
+            found = by_position.get((disc, position))
+            if found is not None:
+                matched_position += set_rating(found, rating)
+                continue
+            # The disc 0 files are only for tracks nothing else matched by position
+            found = by_position.get((0, position))
+            if found is None:
+                continue
+            # A file without a disc number only matches by position when that position is on
+            # a single disc. Otherwise it would be rated once per disc and the last one would win.
+            if discs_with_position is None:
+                discs_with_position = Counter(int(track["position"]) for media in media_list for track in media["tracks"] if "position" in track)
+            if discs_with_position[position] == 1:
+                matched_any_disc += set_rating(found, rating)
+            else:
+                for item in found:
+                    item["ambiguous"] = True
+    for strategy, count in [(MATCH_TRACK_ID, matched_id), (MATCH_POSITION, matched_position), (MATCH_ANY_DISC, matched_any_disc)]:
+        if count > 0:
+            stats[strategy] += count
+
+# Files are written in batches, one batch per task on the pool, so progress can be shown as
+# each batch finishes
+WRITE_BATCH = 64
+
+def write_rating(mediafile:str, email:str, rating:int, writer:TagWriter):
+    '''Sets the POPM frame for email, keeping its play count. Returns an error message or None.'''
+    try:
+        tags = mutagen.id3.ID3(mediafile) # type: ignore
+        count = 0
+        existing = tags.get("POPM:" + email)
+        if existing is not None:
+            count = getattr(existing, "count", 0)
+        tags.add(mutagen.id3.POPM(email=email, rating=rating, count=count)) # type: ignore
+        writer.save(tags)
+    except Exception as e:
+        return "%s: %s" % (mediafile, e)
+    return None
+
+def write_batch(batch:list, email:str, writer:TagWriter) -> list:
+    return [write_rating(recording["path"], email, recording["rating"], writer) for recording in batch]
+
+def apply_to_files(recordings:list, email:str, jobs:int, verbose:bool, writer:TagWriter) -> int:
+    '''Writes the ratings on a thread pool. Returns the number of files written.'''
+    batches = [recordings[i:i + WRITE_BATCH] for i in range(0, len(recordings), WRITE_BATCH)]
+    written = 0
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for errors in pool.map(lambda batch: write_batch(batch, email, writer), batches):
+            for error in errors:
+                if error is None:
+                    written += 1
+                else:
+                    print(Fore.RED + error + Fore.BLACK)
+            done += len(errors)
+            if verbose:
+                print(Fore.GREEN + "Written %d/%d" % (done, len(recordings)) + Fore.BLACK)
+    return written
 
-# get_ext - check that the file extension is supported
-def get_ext(filename, tolower=False) -> str:
-    ext = ""
-    idx = filename.rfind('.')
-    if idx >= 0:
-        ext = filename[idx + 1:]
-    if tolower:
-        return ext.lower()
-    else:
-        return ext
-    
 def main():
     parser = argparse.ArgumentParser(description='Group and rate media files with ID3 tags')
     parser.add_argument('input', help='Media file or a folder of media files')
     parser.add_argument("-s", "--server", help="Perform grouping operation", required=True)
     parser.add_argument("-o", "--output", help="Output File", default="output.bat")
+    parser.add_argument("-a", "--apply", help="Write the ratings to the files instead of generating a script (default: False)", action="store_true", default=False)
+    parser.add_argument("-n", "--dry-run", help="With --apply, report the ratings that would be written without changing any files", action="store_true", default=False)
+    parser.add_argument("--write-jobs", help="Number of files written at once with --apply (default: 4)", default=4, type=int)
     parser.add_argument("-e", "--email", help="Email address for POPM field (default: MusicBee)", default="MusicBee")
     parser.add_argument("-p", "--params", help="Extra eyed3 params (default: --quiet)", default="--quiet")
     parser.add_argument("-z", "--zero", help="Set items with no rating to 0 (default: False)", action="store_true", default=False)
     parser.add_argument("-v", "--verbose", help="Be verbose (default: False)", action="store_true", default=False)
     parser.add_argument("-w", "--overwrite", help="Overwrite existing ratings in POPM tags (default: False)", action="store_true", default=False)
+    parser.add_argument("-j", "--jobs", help="Number of requests to the server at once (default: 1)", default=1, type=int)
+    parser.add_argument("-r", "--rate", help="Maximum requests per second, 0 for no limit (default: %.1f)" % (DEFAULT_RATE), default=DEFAULT_RATE, type=float)
+    parser.add_argument("--retries", help="Retries for a busy (503) server (default: 5)", default=5, type=int)
+    parser.add_argument("--release-cache", help="Cache of server responses (default: %s)" % (DEFAULT_RELEASE_CACHE), default=DEFAULT_RELEASE_CACHE)
+    parser.add_argument("--no-release-cache", help="Always download release data", action="store_true", default=False)
+    parser.add_argument("--ttl", help="Days before cached release data is checked with the server again (default: %.0f)" % (DEFAULT_TTL_DAYS), default=DEFAULT_TTL_DAYS, type=float)
+    parser.add_argument("--offline", help="Only use cached release data, don't contact the server", action="store_true", default=False)
+    parser.add_argument("-c", "--cache", help="Tag cache file (default: %s)" % (DEFAULT_CACHE), default=DEFAULT_CACHE)
+    parser.add_argument("--no-cache", help="Read every file, don't use the tag cache", action="store_true", default=False)
 
     args = parser.parse_args()
 
@@ -50,7 +333,7 @@ def main():
         server = server[0:-1]
 
     # Please use this against your own MB server or be nice to the public server
-    if server.lower().find("musicbrainz.org") >= 0:
+    if server.lower().find("musicbrainz.org") >= 0 and not args.offline:
         resp = ""
         while resp != "I AGREE":
             print(Fore.RED + "Please use a mirror server. Type I AGREE to continue. > " + Fore.BLACK)
@@ -61,88 +344,44 @@ def main():
     extensions = ["mp3"] # TODO: Add m4a, m4b, flac, etc.
 
     # Search input directory for files with the matching extension or if a single file,
-    # Make sure it's the supported extension(s)
-    mediafiles = list()
-    if os.path.isdir(args.input):
-        for root, dirs, files in os.walk(args.input):
-            for file in files:
-                filename = str(file)
-                if get_ext(filename, tolower=True) in extensions:
-                    mediafiles.append(os.path.join(root, file))
-    else:
-        filename = str(args.input)
-        if get_ext(filename, tolower=True) in extensions:
-            mediafiles.append(args.input)
-        else:
-            print("%s is not a supported media file type" % args.input)
-
-    # For convenience sake, sort the list of found media files by path, in case os.walk() didn't
-    mediafiles.sort()
-    
-    if len(mediafiles) == 0:
-        print("No files to process")
-        return
+    # Make sure it's the supported extension(s). Files are streamed from the scanner, so
+    # reading tags starts while the rest of the folder tree is still being walked.
+    mediafiles = find_media(args.input, extensions)
 
     # We only need to call the API once per album, although we have a list of files, so generate
     # a set (unique) of MB album IDs (GUIDs) taken from the source files themselves
-    release_ids = set()
-    total = len(mediafiles)
+    total = 0
     recordings = []
-    if args.verbose:
-        print(Fore.GREEN + "Processing %d Files" % (total) + Fore.BLACK)
     printed = ""
+    cache = None
+    if not args.no_cache:
+        cache = open_cache(args.cache)
     print("Step 1: Find Media Files")
     for mediafile in mediafiles:
+        total += 1
         head,tail = os.path.split(Path(mediafile))
         if args.verbose:
             if head != printed:
                 print(Fore.GREEN + "%s" % (head) + Fore.BLACK)
                 printed = head
         try:
-            id3file = mutagen.id3.ID3(mediafile)
-            if id3file is not None:
-                recording = {
-                    "path": mediafile,
-                    "release_id": "",
-                    "recording_id": "",
-                    "track_no": 0,
-                    "rating": 0,
-                    "exists" : False
-                }
-                for tag in filter(lambda t: t.startswith(("")), id3file):
-                    frame = id3file[tag]
-                    if isinstance(frame, mutagen.id3.TRCK): # type: ignore
-                        track = getattr(frame, "text")
-                        if len(track) > 0:
-                            track_no = track[0]
-                            idx = track_no.find('/')
-                            if idx >= 0:
-                                track_no = track_no[0:idx]
-                            idx = track_no.find('.')
-                            if idx >= 0:
-                                track_no = track_no[0:idx]
-                            recording["track_no"] = int(track_no)
-                    if isinstance(frame, mutagen.id3.POPM): # type: ignore
-                        rating = getattr(frame, "rating")
-                        recording["rating"] = int(rating)
-                        recording["exists"] = True
-                    elif isinstance(frame, mutagen.id3.TXXX): # type: ignore
-                        desc = getattr(frame, "desc")
-                        text = getattr(frame, "text")
-                        if len(text) > 0:
-                            if desc == "MusicBrainz Album Id":
-                                recording["release_id"] = text[0]
-                            elif desc == "MusicBrainz Release Track Id":
-                                recording["recording_id"] = text[0]
-            else:
-                if args.verbose:
-                    print("Can't find necessary ID3 tags for %s" % (mediafile))
-                continue
-
+            tags = load_tags(mediafile, cache, need_length=False)
         except Exception as e:
             print(e)
             continue
 
+        recording = {
+            "path": mediafile,
+            "release_id": tags.release_id,
+            "recording_id": tags.release_track_id,
+            "track_no": number_from_text(tags.track),
+            "disc_no": number_from_text(tags.disc),
+            "matched": False,
+            "ambiguous": False,
+            "rating": tags.rating,
+            "exists" : tags.has_rating
+        }
+
         if recording["track_no"] == 0 or recording["release_id"] == "":
             if args.verbose:
                 print("Can't find necessary ID3 tags for %s" % (mediafile))
@@ -150,110 +389,105 @@ def main():
 
         if (not recording["exists"]) or args.overwrite:
             if recording["rating"] == 0 or args.zero:
-                release_ids.add(recording["release_id"])
                 recordings.append(recording)
 
-    if len(release_ids) == 0:
+    if cache is not None:
+        cache.close()
+
+    if total == 0:
+        print("No files to process")
+        return
+    if args.verbose:
+        print(Fore.GREEN + "Processed %d Files" % (total) + Fore.BLACK)
+
+    if len(recordings) == 0:
         print("No Releases needing changed found among input files at %s" % args.input)
         return
     
-    # Go through the album IDs found and request JSON information about the album from the MB server
-    i = 1
-    total = len(release_ids)
+    # Go through the album IDs found and request JSON information about the album from the MB server.
+    # We only need to call the API once per album, so the recordings are grouped by MB album ID
+    # (GUID) taken from the source files themselves. See benchmark-mbz-matching.py.
+    releases = list(index_recordings(recordings).items())
+    stats = Counter()
+    total = len(releases)
     output_recordings = []
     print("Step 2: Query Server for information on %d releases" % (total))
-    for rid in release_ids:
-        this_release = []
-
-        # Go through the list of recordings in reverse. If a match of release ID is found,
-        # remove the recording from the full list and place it into the list of ones to work
-        # on next. This is so the list will get shorter over time and quicker to traverse,
-        # but also let us know which ones weren't found in MB, so the user can try a better match.
-        for recording in reversed(recordings):
-            if recording['release_id'] == rid:
-                recordings.pop(recordings.index(recording))
-                this_release.append(recording)
-
-        if len(this_release) == 0:
-            print("No recordings found for %s" % (rid))
-            continue
 
-        if args.verbose:
-            path = str(this_release[0]["path"])
-            idx = path.rfind(os.sep)
-            if idx >= 0:
-                path = path[0:idx]
-            print(Fore.GREEN + "Querying %d/%d: %s" % (i, total, path) + Fore.BLACK)
-        i += 1
-
-        payload = {
-            "inc":"aliases+artist-credits+labels+recordings+ratings",
-            "fmt":"json"
-        }
-        headers = {
-            "User-Agent":"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/111.0.0.0 Safari/537.36"
-        }
-        url = server + "/ws/2/release/" + str(rid)
-        
-        response = None
-        try:
-            response = requests.get(url, params=payload, headers=headers)
-            if response.status_code != 200:
-                print("Error %d retrieving data for %s" % (response.status_code, this_release[0]["path"]))
+    # The requests run on a thread pool sharing one session, so connections to the server are
+    # reused. The rate limiter spaces the requests out no matter how many threads there are.
+    # pool.map() hands back the results in the order of the releases.
+    session = make_session(args.jobs, args.retries)
+    limiter = RateLimiter(args.rate)
+    release_cache = None
+    if not args.no_release_cache:
+        release_cache = ReleaseCache(args.release_cache, args.ttl)
+    elif args.offline:
+        print("--offline needs the release cache")
+        return
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        results = pool.map(lambda item: fetch_release(session, limiter, server, item[0], release_cache, args.offline), releases)
+        i = 1
+        for (rid, files), (release, error) in zip(releases, results):
+            first = files.recordings[0]
+            if args.verbose:
+                path = str(first["path"])
+                idx = path.rfind(os.sep)
+                if idx >= 0:
+                    path = path[0:idx]
+                print(Fore.GREEN + "Querying %d/%d: %s" % (i, total, path) + Fore.BLACK)
+            i += 1
+
+            if error is not None:
+                print("%s for %s" % (error, first["path"]))
                 continue
-            
-        except Exception as e:
-            print(e)
-            continue
 
-        release = response.json()
-        if release is None:
-            print("Empty response")
-            continue
+            apply_ratings(release, files, stats)
 
-        # NOTE: This is not great code. It's not Pythonic by any means, but it works. This may not 
-        # work for all album queries and may require some adjustment. 
-        # Basically, look through the list of returned tracks to find the rating if it exists for the 
-        # track. If it does, try to find the track in the list of files with the matching track ID/position
-        for media in release["media"]:
-            if "tracks" in media:
-                for track in media["tracks"]:
-                    if "recording" in track and "position" in track:
-                        recording = track["recording"]
-                        position = int(track["position"])
-                        if "rating" in recording:
-                            rating = recording["rating"]
-                            if "value" in rating:
-                                value = rating["value"]
-                                if value is not None:
-                                    rating = int(float(value) * 51.0)
-                                    for item in this_release:
-                                        if item["track_no"] == position:
-                                            item["rating"] = rating
-                                            break
-
-        # Generate the output. This is a generic script output and should be compliant with
-        # bash, powershell, CMD, etc. so long as the eyed3 module is installed.
-        for recording in this_release:
-            output_recordings.append(recording)
+            # Generate the output. This is a generic script output and should be compliant with
+            # bash, powershell, CMD, etc. so long as the eyed3 module is installed.
+            output_recordings.extend(files.recordings)
+    session.close()
+    if release_cache is not None:
+        if args.verbose:
+            print(Fore.GREEN + "Release cache: %d cached, %d unchanged on server, %d downloaded" % (release_cache.hits, release_cache.revalidated, release_cache.downloaded) + Fore.BLACK)
+        release_cache.close()
         
-    # To be honest, this should probably just reopen the file with mutagen and write the POPM
-    # tag directly, but I'll use this for now.
     sorted_recordings = sorted(output_recordings, key=lambda k: k["path"])
+    to_write = [recording for recording in sorted_recordings if recording["rating"] > 0 or args.zero]
 
-    outfile = open(args.output, "wt", encoding="utf-8")
-    for recording in sorted_recordings:
-        if recording["rating"] > 0 or args.zero:
+    if args.apply:
+        # Write the POPM frames in-process rather than starting eyed3 once per file
+        if args.dry_run:
+            for recording in to_write:
+                print("%s: %d" % (recording["path"], recording["rating"]))
+            print(Fore.GREEN + "Dry run: %d files would be rated" % (len(to_write)) + Fore.BLACK)
+        else:
+            writer = TagWriter()
+            written = apply_to_files(to_write, args.email, args.write_jobs, args.verbose, writer)
+            print(Fore.GREEN + "Rated %d of %d files: %s" % (written, len(to_write), writer.summary()) + Fore.BLACK)
+    else:
+        outfile = open(args.output, "wt", encoding="utf-8")
+        for recording in to_write:
             outfile.write("eyed3 \"%s\" --add-popularity \"%s:%d:0\" %s\n" % 
                           (recording["path"], args.email, recording["rating"], args.params))
-    outfile.close()  
+        outfile.close()  
 
     # Let the user know that some files didn't match in the database. If this happens, they may
     # Want to update their MB IDs with Picard.
-    if len(recordings) > 0:
-        print(Fore.YELLOW + "NOTE: Ratings were not found for some recordings" + Fore.BLACK)
-        for recording in recordings:
+    unmatched = [recording for recording in recordings if not recording["matched"]]
+    ambiguous = [recording for recording in unmatched if recording["ambiguous"]]
+    print(Fore.GREEN + "Matched %d files: %d by %s, %d by %s, %d by %s. %d not matched, %d of them ambiguous" %
+          (len(recordings) - len(unmatched), stats[MATCH_TRACK_ID], MATCH_TRACK_ID, stats[MATCH_POSITION], MATCH_POSITION,
+           stats[MATCH_ANY_DISC], MATCH_ANY_DISC, len(unmatched), len(ambiguous)) + Fore.BLACK)
+    if len(ambiguous) > 0:
+        print(Fore.YELLOW + "NOTE: These recordings have no disc number and their track number is on more than one disc of the release" + Fore.BLACK)
+        for recording in sorted(ambiguous, key=lambda k: k["path"]):
             print("%s" % (recording["path"]))
+    if len(unmatched) > len(ambiguous):
+        print(Fore.YELLOW + "NOTE: Some recordings were not found in their MusicBrainz release" + Fore.BLACK)
+        for recording in sorted(unmatched, key=lambda k: k["path"]):
+            if not recording["ambiguous"]:
+                print("%s" % (recording["path"]))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
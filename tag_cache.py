@@ -0,0 +1,113 @@
+'''
+tag_cache - Persistent cache of parsed tags, keyed by path and invalidated by size + mtime
+
+Opening every MP3 with mutagen is the slow part of a full library scan. Almost nothing
+changes between runs, so the TrackTags read from each file are kept in a SQLite database
+together with the file size and modification time. On the next run an unchanged file only
+costs a stat(). Any change to a file (e.g. a tag edit) changes its mtime, so the entry is
+re-read automatically.
+
+The cache is shared between the scripts, so the nightly generate-metadata-list run also
+warms it for group-actions, lint-metadata and search-mbz-ratings.
+'''
+
+import os
+import sys
+import json
+import sqlite3
+from media_tags import TrackTags, LENGTH_UNKNOWN, read_tags, read_tags_only, read_length
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".media-tag-cache.sqlite")
+
+# Bump this when TrackTags changes so stale entries are thrown away
+CACHE_VERSION = 1
+
+# Commit every so often so an interrupted scan keeps most of its work
+COMMIT_INTERVAL = 500
+
+class TagCache:
+    def __init__(self, filename:str=DEFAULT_CACHE):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+        self.db = sqlite3.connect(filename)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != CACHE_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS tags")
+            self.db.execute("PRAGMA user_version=%d" % (CACHE_VERSION))
+        self.db.execute("CREATE TABLE IF NOT EXISTS tags (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, data TEXT)")
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def key(path:str) -> str:
+        return os.path.abspath(path)
+
+    def get(self, path:str, st:os.stat_result) -> TrackTags | None:
+        row = self.db.execute("SELECT size, mtime, data FROM tags WHERE path = ?", (self.key(path),)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            self.misses += 1
+            return None
+        self.hits += 1
+        tags = TrackTags.fromDict(json.loads(row[2]))
+        tags.path = path
+        return tags
+
+    def put(self, path:str, st:os.stat_result, tags:TrackTags):
+        self.db.execute("INSERT OR REPLACE INTO tags (path, size, mtime, data) VALUES (?, ?, ?, ?)",
+                        (self.key(path), st.st_size, st.st_mtime_ns, json.dumps(tags.toDict())))
+        self.pending += 1
+        if self.pending >= COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+def open_cache(filename:str|None) -> TagCache | None:
+    '''Opens the cache, or returns None (no caching) when filename is None or unusable.'''
+    if filename is None:
+        return None
+    try:
+        return TagCache(filename)
+    except sqlite3.Error as e:
+        print("Tag cache %s not available: %s" % (filename, e), file=sys.stderr)
+        return None
+
+def load_tags(mediafile:str, cache:TagCache|None=None, st:os.stat_result|None=None, need_length:bool=True) -> TrackTags:
+    '''
+    Returns the tags for mediafile from the cache if the file is unchanged, otherwise reads
+    the file and updates the cache. Raises the mutagen/OS error if the file can't be read.
+    Pass st if the caller already has the file's stat() result.
+
+    With need_length=False only the tag block at the start of the file is read and length is
+    left as LENGTH_UNKNOWN. It is filled in later, the first time a caller needs it.
+    '''
+    if cache is None:
+        if need_length:
+            return read_tags(mediafile)
+        return read_tags_only(mediafile)
+    if st is None:
+        st = os.stat(mediafile)
+    tags = cache.get(mediafile, st)
+    if tags is None:
+        if need_length:
+            tags = read_tags(mediafile)
+        else:
+            tags = read_tags_only(mediafile)
+        cache.put(mediafile, st, tags)
+    elif need_length and tags.length == LENGTH_UNKNOWN:
+        tags.length = read_length(mediafile)
+        cache.put(mediafile, st, tags)
+    return tags
@@ -0,0 +1,110 @@
+'''
+tag_writer - Saves ID3 tags without rewriting the whole file whenever possible
+
+An ID3v2 tag sits at the start of the MP3, usually followed by some zero padding. When an
+edited tag still fits in the old tag plus its padding, it is written in place and the audio
+isn't touched. When it doesn't fit, the whole file has to be rewritten to make room, which
+on a NAS means copying the entire MP3 over the network for a one frame change.
+
+TagWriter saves with a padding policy that never gives padding back (mutagen's default shrinks
+large padding, which is itself a rewrite) and leaves DEFAULT_PADDING of room whenever a rewrite
+can't be avoided, so the next GRP1 or POPM edit is written in place. It counts which saves were
+in place and which were rewrites. repad-library.py does the rewrite once for a whole library.
+'''
+
+import os
+import threading
+from file_sizes import format_bytes
+from media_tags import read_id3_block
+
+# Room left after the tag when a file has to be rewritten anyway
+DEFAULT_PADDING = 64 * 1024
+
+def synchsafe(data:bytes) -> int:
+    return (data[0] & 0x7f) << 21 | (data[1] & 0x7f) << 14 | (data[2] & 0x7f) << 7 | (data[3] & 0x7f)
+
+def id3_padding(mediafile:str) -> int:
+    '''
+    Returns the padding after the ID3v2 tag at the start of mediafile, or -1 if it has no
+    ID3v2 tag. The frame headers are walked to the end of the last frame, the same way mutagen
+    finds the padding when it saves, so a frame whose data ends in zero bytes isn't counted.
+    '''
+    block = read_id3_block(mediafile)
+    if len(block) == 0:
+        return -1
+    version = block[3]
+    flags = block[5]
+    data = block[10:]
+    if flags & 0x10:
+        # Footer
+        data = data[:-10]
+    if version < 4 and flags & 0x80:
+        # The whole tag is unsynchronised, and frame sizes count the bytes after undoing it
+        data = data.replace(b"\xff\x00", b"\xff")
+    pos = 0
+    if flags & 0x40 and len(data) >= 4:
+        # Extended header. In 2.4 its size counts itself, in 2.3 it doesn't.
+        if version == 4:
+            pos = synchsafe(data[0:4])
+        else:
+            pos = 4 + int.from_bytes(data[0:4], "big")
+
+    # 2.2 frames have a 3 byte id and a 3 byte size, 2.3 and 2.4 a 4 byte id, size and 2 bytes of flags
+    header_size = 10
+    id_size = 4
+    if version == 2:
+        header_size = 6
+        id_size = 3
+    while pos + header_size <= len(data):
+        header = data[pos:pos + header_size]
+        if header[0:id_size].strip(b"\0") == b"":
+            break
+        if version == 2:
+            size = int.from_bytes(header[3:6], "big")
+        elif version == 3:
+            size = int.from_bytes(header[4:8], "big")
+        else:
+            size = synchsafe(header[4:8])
+        pos += header_size + size
+    return max(len(data) - pos, 0)
+
+class TagWriter:
+    '''Saves tags and keeps count of in-place saves and full rewrites. Safe to share between threads.'''
+    def __init__(self, padding:int=DEFAULT_PADDING):
+        self.padding = padding
+        self.in_place = 0
+        self.rewritten = 0
+        self.rewritten_bytes = 0
+        self.lock = threading.Lock()
+
+    def save(self, tags, filename:str|None=None, padding:int|None=None) -> bool:
+        '''
+        Saves tags, an ID3 loaded from filename (or from its own file if filename is None).
+        Returns True if the whole file was rewritten. Pass padding to force a rewrite unless
+        the tag already has at least that much room after it.
+        '''
+        wanted = 0
+        if padding is not None:
+            wanted = padding
+        rewrite = [False]
+
+        def choose_padding(info):
+            if info.padding >= wanted:
+                return info.padding
+            rewrite[0] = True
+            return max(self.padding, wanted)
+
+        tags.save(filename, padding=choose_padding)
+        if filename is None:
+            filename = tags.filename
+        with self.lock:
+            if rewrite[0]:
+                self.rewritten += 1
+                self.rewritten_bytes += os.path.getsize(str(filename))
+            else:
+                self.in_place += 1
+        return rewrite[0]
+
+    def summary(self) -> str:
+        return "%d saved in place, %d rewritten (%s)" % (self.in_place, self.rewritten, format_bytes(self.rewritten_bytes))
+